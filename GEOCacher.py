@@ -1,6 +1,14 @@
 import sqlite3
 import urllib2
+import argparse
 import zlib
+import re
+import datetime
+import time
+import threading
+from multiprocessing.pool import ThreadPool
+
+import instrument
 
 
 STR_NOT_FOUND = "Could not find a public or private accession"
@@ -8,53 +16,271 @@ STR_DELETED = "was deleted by the GEO staff"
 STR_PRIVATE = "is currently private and is scheduled to be released"
 STR_WAIT_APPROVAL = "is not yet approved by GEO curators"
 
+GEO_URL = "http://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc="
+
+PUBLIC_ON_EXPR = re.compile("Public on ([^<]*)<")
+TITLE_EXPR = re.compile("<td[^>]*>Title</td>\s*<td[^>]*>(.*?)</td>", re.S)
 
+
+# geo_status holds the latest state of every GSE, geo_history the previous
+# checks (at most history_size per GSE). geo_pages is the table of raw pages
+# written by older versions, its rows are parsed into geo_status when they
+# are first looked up and removed by compact().
 CREATE_SCRIPT = """
-create table if not exists geo_pages(gse text, checked_date real, value blob);
-create index if not exists geo_pages_gse_idx on geo_pages(gse);
+create table if not exists geo_status(gse text primary key, checked_date real, status text, public_on date, title text, value blob);
+
+create table if not exists geo_history(gse text, checked_date real, status text, public_on date, title text, value blob);
+create index if not exists geo_history_gse_date_idx on geo_history(gse, checked_date);
 """
 
+RECORD_COLUMNS = ["gse", "checked_date", "status", "public_on", "title"]
+
+
+class RateLimiter(object):
+    # spaces out calls to wait() to at most `rate` per second, across threads
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def is_retryable(e):
+    if isinstance(e, urllib2.HTTPError):
+        return e.code == 429 or e.code >= 500
+    return isinstance(e, IOError)
+
+
+def fetch_url(url, limiter=None, retries=3, backoff=1.0, timeout=60):
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.wait()
+        start = time.time()
+        try:
+            data = urllib2.urlopen(url, timeout=timeout).read()
+            instrument.observe("http.fetch_url", time.time() - start)
+            return data
+        except Exception as e:
+            instrument.observe("http.fetch_url", time.time() - start)
+            instrument.count("http.fetch_url.errors")
+            if attempt >= retries or not is_retryable(e):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+
+def check_gse_data(data):
+    if STR_PRIVATE in data or STR_WAIT_APPROVAL in data:
+        return "private"
+    elif STR_DELETED in data or STR_NOT_FOUND in data:
+        return "missing"
+    else:
+        return "present"
+
+
+# the pages write "Aug 01, 2012", GEOmetadb "Aug 01 2012"
+PUBLIC_DATE_FORMATS = ["%b %d, %Y", "%b %d %Y"]
+
+
+def parse_public_date(s):
+    for fmt in PUBLIC_DATE_FORMATS:
+        try:
+            return str(datetime.datetime.strptime(s.strip(), fmt).date())
+        except ValueError:
+            pass
+    return None
+
+
+def parse_geo_page(data):
+    result = {"status": check_gse_data(data), "public_on": None, "title": None}
+    m = PUBLIC_ON_EXPR.search(data)
+    if m is not None:
+        result["public_on"] = parse_public_date(m.group(1))
+    m = TITLE_EXPR.search(data)
+    if m is not None:
+        result["title"] = m.group(1).strip()
+    return result
+
 
 class GEOCacher(object):
-    def __init__(self, db_filename):
-        self.cache_db = sqlite3.connect(db_filename)
+    def __init__(self, db_filename, base_url=GEO_URL, rate=3, workers=4,
+                 retries=3, backoff=1.0, keep_pages=False, history_size=0):
+        self.cache_db = instrument.connect(db_filename)
         self.cache_db.executescript(CREATE_SCRIPT)
+        self.has_legacy_pages = len(self.cache_db.execute(
+            "select name from sqlite_master where type='table' and name='geo_pages'").fetchall()) > 0
+        self.base_url = base_url
+        # NCBI allows 3 requests per second without an API key
+        self.limiter = RateLimiter(rate)
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        # store the compressed page next to the parsed fields
+        self.keep_pages = keep_pages
+        # number of previous checks kept per GSE in geo_history
+        self.history_size = history_size
 
     def _gse2url(self, gse):
-        return "http://www.ncbi.nlm.nih.gov/geo/query/acc.cgi?acc=" + gse
+        return self.base_url + gse
 
-    def get_geo_page(self, gse, maxlag=7):
-        sql = """select * from geo_pages where gse=? and
-                        checked_date + ? > julianday(datetime('now')) order by checked_date desc limit 1"""
-        cur = self.cache_db.execute(sql, (gse, maxlag))
-        data = cur.fetchall()
-        if len(data) > 0:
-            return zlib.decompress(bytes(data[0][2]))
-        
+    def _fetch_geo_page(self, gse):
         try:
-            data = urllib2.urlopen(self._gse2url(gse)).read()
+            return fetch_url(self._gse2url(gse), self.limiter, self.retries,
+                             self.backoff)
         except Exception as e:
             print "Error while fetching data for GSE: ", gse
             print "URL: ", self._gse2url(gse)
             print e
             raise e
-        data_compr = zlib.compress(data)
-        self.cache_db.execute("insert into geo_pages(gse, checked_date, value) values (?, julianday(datetime('now')), ?)", (gse, sqlite3.Binary(data_compr)))
-        self.cache_db.commit()
-        return data
+
+    def _insert_record(self, gse, checked_date, data, commit=True):
+        record = parse_geo_page(data)
+        record["gse"] = gse
+        record["checked_date"] = checked_date
+        value = None
+        if self.keep_pages:
+            value = sqlite3.Binary(zlib.compress(data))
+
+        if self.history_size > 0:
+            self.cache_db.execute("insert into geo_history(gse, checked_date, status, public_on, title) select gse, checked_date, status, public_on, title from geo_status where gse=?", (gse,))
+            self.cache_db.execute("""delete from geo_history where gse=? and rowid not in
+                        (select rowid from geo_history where gse=? order by checked_date desc limit ?)""",
+                                  (gse, gse, self.history_size))
+        self.cache_db.execute("insert or replace into geo_status(gse, checked_date, status, public_on, title, value) values (?, ?, ?, ?, ?, ?)",
+                              (gse, checked_date, record["status"], record["public_on"], record["title"], value))
+        if commit:
+            self.cache_db.commit()
+        return record
+
+    def _get_legacy_record(self, gse, maxlag):
+        # raw pages cached by older versions
+        if not self.has_legacy_pages:
+            return None
+        sql = """select checked_date, value from geo_pages where gse=? and
+                        checked_date + ? > julianday(datetime('now')) order by checked_date desc limit 1"""
+        data = self.cache_db.execute(sql, (gse, maxlag)).fetchall()
+        if len(data) == 0:
+            return None
+        (checked_date, value) = data[0]
+        return self._insert_record(gse, checked_date, zlib.decompress(bytes(value)))
+
+    def _get_cached_record(self, gse, maxlag):
+        sql = """select gse, checked_date, status, public_on, title,
+                        checked_date + ? > julianday(datetime('now')) from geo_status where gse=?"""
+        data = self.cache_db.execute(sql, (maxlag, gse)).fetchall()
+        if len(data) == 0:
+            return self._get_legacy_record(gse, maxlag)
+        if data[0][-1]:
+            return dict(zip(RECORD_COLUMNS, data[0]))
+        return None
+
+    def _store_page(self, gse, data):
+        now = self.cache_db.execute("select julianday(datetime('now'))").fetchone()[0]
+        return self._insert_record(gse, now, data)
+
+    def get_geo_record(self, gse, maxlag=7):
+        record = self._get_cached_record(gse, maxlag)
+        if record is not None:
+            instrument.count("geo_cache.hit")
+            return record
+
+        instrument.count("geo_cache.miss")
+        return self._store_page(gse, self._fetch_geo_page(gse))
+
+    def get_geo_records_many(self, gses, maxlag=7):
+        result = {}
+        missing = []
+        for gse in set(gses):
+            record = self._get_cached_record(gse, maxlag)
+            if record is None:
+                missing.append(gse)
+            else:
+                result[gse] = record
+        instrument.count("geo_cache.hit", len(result))
+        instrument.count("geo_cache.miss", len(missing))
+
+        if len(missing) == 0:
+            return result
+
+        # pages are downloaded by the pool threads, but only this thread
+        # parses them and writes them to the cache database
+        fetch = lambda gse: (gse, self._fetch_geo_page(gse))
+        pool = ThreadPool(self.workers)
+        try:
+            for (gse, data) in pool.imap_unordered(fetch, missing):
+                result[gse] = self._store_page(gse, data)
+        finally:
+            pool.terminate()
+            pool.join()
+        return result
 
     def check_gse_data(self, data):
-        if STR_PRIVATE in data or STR_WAIT_APPROVAL in data:
-            return "private"
-        elif STR_DELETED in data or STR_NOT_FOUND in data:
-            return "missing"
-        else:
-            return "present"
+        return check_gse_data(data)
 
     def check_gse_cached(self, gse, maxlag=7, skip_present=True):
         if skip_present:
-            old_data = self.get_geo_page(gse, 365*20)
-            if self.check_gse_data(old_data) == "present":
+            old_record = self.get_geo_record(gse, 365*20)
+            if old_record["status"] == "present":
                 return "present"
-        data = self.get_geo_page(gse, maxlag)
-        return self.check_gse_data(data)
+        return self.get_geo_record(gse, maxlag)["status"]
+
+    def check_gse_cached_many(self, gses, maxlag=7, skip_present=True):
+        statuses = {}
+        if skip_present:
+            for gse in set(gses):
+                old_record = self._get_cached_record(gse, 365*20)
+                if old_record is not None and old_record["status"] == "present":
+                    statuses[gse] = "present"
+        remaining = [gse for gse in gses if gse not in statuses]
+        for (gse, record) in self.get_geo_records_many(remaining, maxlag).items():
+            statuses[gse] = record["status"]
+        return statuses
+
+    def compact(self, vacuum=True):
+        # move the pages still in geo_pages into geo_status, trim geo_history
+        # to history_size checks per GSE and reclaim the space
+        if self.has_legacy_pages:
+            sql = """select gse, max(checked_date), value from geo_pages
+                        where gse not in (select gse from geo_status) group by gse"""
+            for (gse, checked_date, value) in self.cache_db.execute(sql).fetchall():
+                self._insert_record(gse, checked_date, zlib.decompress(bytes(value)),
+                                    commit=False)
+            self.cache_db.execute("drop table geo_pages")
+            self.has_legacy_pages = False
+
+        self.cache_db.execute("""delete from geo_history where rowid not in
+                        (select h.rowid from geo_history h where h.gse = geo_history.gse
+                         order by h.checked_date desc limit ?)""", (self.history_size,))
+        self.cache_db.commit()
+
+        if vacuum:
+            self.cache_db.execute("VACUUM")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance of the GEO page cache')
+
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("--db", default="data/cache.sqlite")
+    parser.add_argument("--history", type=int, default=0,
+                        help="previous checks to keep per GSE")
+    parser.add_argument("--no-vacuum", action="store_true")
+
+    args = parser.parse_args()
+
+    cache = GEOCacher(args.db, history_size=args.history)
+    if args.command == "compact":
+        cache.compact(vacuum=not args.no_vacuum)
+        print "Cached GSEs: ", cache.cache_db.execute("select count(*) from geo_status").fetchone()[0]
+
+if __name__ == "__main__":
+    main()
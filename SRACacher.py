@@ -0,0 +1,139 @@
+import json
+import re
+import time
+import requests
+
+from GEOCacher import RateLimiter, fetch_url
+import instrument
+
+
+URL_esearch = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
+URL_efetch = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+SRA_URL = "https://www.ncbi.nlm.nih.gov/sra/?term="
+
+STR_NOT_PUBLIC = " is not public"
+STR_REMOVED = "Record is removed"
+
+# states that do not change anymore, they are never checked again
+TERMINAL_STATUSES = ["public", "removed"]
+
+
+CREATE_SCRIPT = """
+create table if not exists sra_status(srx text primary key, checked_date real, status text);
+"""
+
+
+def get_data_about_accessions(db, accs, limiter=None):
+    req_str = "db=" + db + "&retmode=json&retmax=50000&usehistory=y&term=" + "+OR+".join(map(lambda x: x + "[accn]", accs))
+    if limiter is not None:
+        limiter.wait()
+    start = time.time()
+    resp = requests.post(URL_esearch, data=req_str)
+    instrument.observe("http.eutils", time.time() - start)
+    resp.raise_for_status()
+    jdata = json.loads(resp.content)["esearchresult"]
+    if "querykey" not in jdata:
+        # none of the accessions was found
+        return ""
+    qkey = jdata["querykey"]
+    webenv = jdata["webenv"]
+
+    if limiter is not None:
+        limiter.wait()
+    start = time.time()
+    resp2 = requests.get(URL_efetch, {"db" : db, "query_key" : qkey, "webenv" : webenv, "retmax" : len(accs), "email" : "grechkin@cs.washington.edu"})
+    instrument.observe("http.eutils", time.time() - start)
+    resp2.raise_for_status()
+
+    return resp2.content
+
+
+def check_srx_data(srx, data):
+    if (srx + STR_NOT_PUBLIC) in data:
+        return "private"
+    elif re.search(re.escape(srx) + "(?![0-9])", data) is not None:
+        return "public"
+    else:
+        return "missing"
+
+
+class SRACacher(object):
+    # Caches the NCBI status of SRA experiments: "public", "private" (not
+    # public, but not removed either), "removed", or "missing" when NCBI
+    # does not know the accession at all.
+
+    def __init__(self, db_filename, rate=3, retries=3, backoff=1.0,
+                 chunk_size=200):
+        self.cache_db = instrument.connect(db_filename)
+        self.cache_db.executescript(CREATE_SCRIPT)
+        # NCBI allows 3 requests per second without an API key
+        self.limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.chunk_size = chunk_size
+
+    def _srx2url(self, srx):
+        return SRA_URL + srx
+
+    def _with_retries(self, func, *args):
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except (requests.RequestException, IOError, ValueError):
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def _get_cached_status(self, srx, maxlag):
+        sql = """select status, checked_date + ? > julianday(datetime('now')) from sra_status
+                        where srx=?"""
+        data = self.cache_db.execute(sql, (maxlag, srx)).fetchall()
+        if len(data) == 0:
+            return None
+        (status, fresh) = data[0]
+        if fresh or status in TERMINAL_STATUSES:
+            return status
+        return None
+
+    def _store_status(self, srx, status):
+        self.cache_db.execute("insert or replace into sra_status(srx, checked_date, status) values (?, julianday(datetime('now')), ?)",
+                              (srx, status))
+
+    def _is_removed(self, srx):
+        data = fetch_url(self._srx2url(srx), self.limiter, self.retries,
+                         self.backoff)
+        return STR_REMOVED in data
+
+    def _fetch_statuses(self, srxs):
+        statuses = {}
+        for i in range(0, len(srxs), self.chunk_size):
+            chunk = srxs[i:i + self.chunk_size]
+            data = self._with_retries(get_data_about_accessions, "sra", chunk,
+                                      self.limiter).decode("utf-8")
+            for srx in chunk:
+                status = check_srx_data(srx, data)
+                if status == "private" and self._is_removed(srx):
+                    status = "removed"
+                statuses[srx] = status
+                self._store_status(srx, status)
+            self.cache_db.commit()
+        return statuses
+
+    def check_srx_cached(self, srx, maxlag=7):
+        return self.check_srx_cached_many([srx], maxlag)[srx]
+
+    def check_srx_cached_many(self, srxs, maxlag=7):
+        statuses = {}
+        missing = []
+        for srx in set(srxs):
+            status = self._get_cached_status(srx, maxlag)
+            if status is None:
+                missing.append(srx)
+            else:
+                statuses[srx] = status
+        instrument.count("sra_cache.hit", len(statuses))
+        instrument.count("sra_cache.miss", len(missing))
+        statuses.update(self._fetch_statuses(sorted(missing)))
+        return statuses
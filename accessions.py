@@ -0,0 +1,86 @@
+# Registry of the accession families datawatch tracks. Each family declares
+# the literal prefix and the pattern used to find its accessions in the
+# articles, and, if we can check its release status, how to open its cache
+# and resolve the status of a list of accessions with it. The family name is
+# stored in mentions.acc_type.
+
+
+class AccessionFamily(object):
+    def __init__(self, name, prefix, pattern, open_cache=None, resolve=None):
+        self.name = name
+        self.prefix = prefix
+        self.pattern = pattern
+        # open_cache() returns the cache object passed to resolve
+        self.open_cache = open_cache
+        # resolve(cache, accs, maxlag) returns a dict from accession to status
+        self.resolve = resolve
+
+
+FAMILIES = {}
+
+
+def register(family):
+    FAMILIES[family.name] = family
+
+
+def open_geo_cache():
+    import GEOCacher
+    return GEOCacher.GEOCacher("data/cache.sqlite")
+
+
+def resolve_geo(cache, accs, maxlag):
+    return cache.check_gse_cached_many(accs, maxlag=maxlag)
+
+
+def open_sra_cache():
+    import SRACacher
+    return SRACacher.SRACacher("data/sra_cache.sqlite")
+
+
+def resolve_sra(cache, accs, maxlag):
+    return cache.check_srx_cached_many(accs, maxlag=maxlag)
+
+
+register(AccessionFamily("GSE", "GSE", "GSE[0-9]+", open_geo_cache, resolve_geo))
+register(AccessionFamily("SRX", "SRX", "SRX[0-9]+", open_sra_cache, resolve_sra))
+register(AccessionFamily("SRP", "SRP", "SRP[0-9]+"))
+register(AccessionFamily("PRJNA", "PRJNA", "PRJNA[0-9]+"))
+register(AccessionFamily("E-MTAB", "E-MTAB-", "E-MTAB-[0-9]+"))
+
+DEFAULT_FAMILIES = ["GSE", "SRX"]
+
+
+def acc_type(acc):
+    for family in FAMILIES.values():
+        if acc.startswith(family.prefix):
+            return family.name
+    return None
+
+
+def ensure_acc_type(dbcon):
+    # databases created before acc_type existed get the column and have it
+    # filled in once
+    columns = [row[1] for row in dbcon.execute("pragma table_info(mentions)")]
+    if "acc_type" not in columns:
+        dbcon.execute("alter table mentions add column acc_type text")
+        for family in FAMILIES.values():
+            dbcon.execute("update mentions set acc_type=? where acc_type is null and acc GLOB ?",
+                          (family.name, family.prefix + "*"))
+        dbcon.execute(
+            "create index if not exists mentions_acc_type_idx on mentions(acc_type, acc)")
+        dbcon.commit()
+
+
+def mentioned_accessions(dbcon, name):
+    cur = dbcon.execute(
+        "select distinct acc from mentions where acc_type=?", (name,))
+    return [x[0] for x in cur.fetchall()]
+
+
+def resolve_statuses(name, accs, maxlag=7, cache=None):
+    family = FAMILIES[name]
+    if family.resolve is None:
+        raise ValueError("No status resolver for " + name + " accessions")
+    if cache is None:
+        cache = family.open_cache()
+    return family.resolve(cache, accs, maxlag)
@@ -0,0 +1,272 @@
+# Generators of synthetic inputs for the benchmarks: PMC archives of JATS
+# articles, GEOmetadb and SRAmetadb files, and the pages NCBI would serve for
+# the accessions that are not in them. Everything is derived from the article
+# number, so the stub server can answer without reading the fixtures.
+
+import tarfile
+import sqlite3
+import datetime
+import random
+import io
+import os
+import multiprocessing
+
+
+JOURNALS = ["Nature", "Cell", "PLoS One", "Nucleic Acids Res", "BMC Genomics",
+            "Genome Res", "Sci Rep", "Oncotarget", "Elife", "Genome Biol"]
+
+FIRST_DATE = datetime.date(2008, 1, 1)
+
+# changes whenever the generated data does, so that older fixtures are not
+# reused and reports are only compared on the same data
+VERSION = 2
+
+WORDS = ("gene expression cells were sequenced using the protocol described "
+         "previously and the reads aligned to the reference genome with "
+         "default parameters samples").split()
+
+ARTICLE_TEMPLATE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE article PUBLIC "-//NLM//DTD Journal Archiving and Interchange DTD v3.0 20080202//EN" "archivearticle3.dtd">
+<article xmlns:xlink="http://www.w3.org/1999/xlink" article-type="research-article">
+<front>
+<journal-meta><journal-id journal-id-type="nlm-ta">%(journal)s</journal-id></journal-meta>
+<article-meta>
+<article-id pub-id-type="pmid">%(pmid)d</article-id>
+<article-id pub-id-type="pmc">%(pmc)d</article-id>
+<article-id pub-id-type="doi">10.5555/bench.%(pmc)d</article-id>
+<title-group><article-title>Synthetic study <italic>%(pmc)d</italic> of %(topic)s</article-title></title-group>
+<contrib-group>%(authors)s</contrib-group>
+<pub-date pub-type="epub"><day>%(day)d</day><month>%(month)d</month><year>%(year)d</year></pub-date>
+</article-meta>
+</front>
+<body><sec><title>Methods</title><p>%(body)s</p></sec></body>
+</article>
+"""
+
+AUTHOR_TEMPLATE = u"""<contrib contrib-type="author"><name><surname>%s</surname><given-names>%s</given-names></name></contrib>"""
+
+
+def article_pmid(i):
+    return 1000000 + i
+
+
+def article_pmc(i):
+    return 3000000 + i
+
+
+def article_journal(i):
+    # independent of gse_every, so that the articles with accessions are
+    # spread over all journals
+    return JOURNALS[spread(i) % len(JOURNALS)]
+
+
+def article_date(i):
+    return FIRST_DATE + datetime.timedelta(i * 7 % 3200)
+
+
+def article_gses(i, gse_every):
+    # every gse_every-th article deposits a series, and some of them also
+    # mention the series of an earlier article
+    if i % gse_every != 0:
+        return []
+    gses = ["GSE%d" % (100000 + i)]
+    if i % (3 * gse_every) == 0 and i >= 5 * gse_every:
+        gses.append("GSE%d" % (100000 + i - 5 * gse_every))
+    return gses
+
+
+def article_srxs(i, srx_every):
+    if i % srx_every != 0:
+        return []
+    return ["SRX%d" % (200000 + i)]
+
+
+def make_filler(size):
+    # shared text the article bodies are cut from, generating words for
+    # every article would dominate the time to build large archives
+    rng = random.Random(0)
+    words = [rng.choice(WORDS) for k in range(size // 4)]
+    return u" ".join(words)
+
+
+def make_article(i, accs, body_size, filler):
+    rng = random.Random(i)
+    date = article_date(i)
+    authors = [AUTHOR_TEMPLATE % ("Author%d" % rng.randint(0, 50000), "A")
+               for k in range(rng.randint(1, 8))]
+    start = rng.randint(0, len(filler) - body_size)
+    parts = [filler[start:start + body_size // 2]] + accs + \
+        [filler[start + body_size // 2:start + body_size]]
+    values = {"journal": article_journal(i), "pmid": article_pmid(i),
+              "pmc": article_pmc(i), "topic": rng.choice(WORDS),
+              "authors": u"".join(authors), "day": date.day,
+              "month": date.month, "year": date.year, "body": u" ".join(parts)}
+    return (ARTICLE_TEMPLATE % values).encode("utf-8")
+
+
+def make_pmc_archive(params):
+    (fn, first, last, gse_every, srx_every, body_size) = params
+    filler = make_filler(4 * body_size)
+    tf = tarfile.open(fn, "w:gz", compresslevel=6)
+    for i in range(first, last):
+        accs = article_gses(i, gse_every) + article_srxs(i, srx_every)
+        data = make_article(i, accs, body_size, filler)
+        info = tarfile.TarInfo("%s/PMC%d.nxml" % (
+            article_journal(i).replace(" ", "_"), article_pmc(i)))
+        info.size = len(data)
+        info.mtime = 1500000000
+        tf.addfile(info, io.BytesIO(data))
+    tf.close()
+    return fn
+
+
+def make_pmc_archives(dirname, n_articles, n_archives, gse_every, srx_every,
+                      body_size, jobs=1):
+    # compression takes most of the time, so archives are written in parallel
+    per_archive = (n_articles + n_archives - 1) // n_archives
+    params = [(os.path.join(dirname, "articles.%03d.xml.tar.gz" % k),
+               k * per_archive, min(n_articles, (k + 1) * per_archive),
+               gse_every, srx_every, body_size) for k in range(n_archives)]
+    if jobs <= 1:
+        return map(make_pmc_archive, params)
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(make_pmc_archive, params)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def spread(n):
+    # accession numbers follow the article numbers, mixed so that the
+    # properties derived from them do not depend on gse_every/srx_every
+    return (n * 2654435761) % 2 ** 32 >> 8
+
+
+# the mentioned series are split by their number: most are in GEOmetadb,
+# the rest is left to the GEO website, which lists them as public, private
+# or missing
+def gse_in_metadb(n):
+    return spread(n) % 5 != 0
+
+
+def gse_web_status(n):
+    return ["public", "private", "missing"][spread(n) // 5 % 3]
+
+
+GEOMETADB_SCRIPT = """
+create table gse(ID REAL, title TEXT, gse TEXT, status TEXT, submission_date TEXT, last_update_date TEXT, pubmed_id INTEGER);
+create table gsm(ID REAL, title TEXT, gsm TEXT, status TEXT, submission_date TEXT, last_update_date TEXT);
+create table gse_gsm(gse TEXT, gsm TEXT);
+create table metaInfo(name varchar(50), value varchar(50));
+"""
+
+
+def geo_status_date(date):
+    return "Public on " + date.strftime("%b %d %Y")
+
+
+def make_geometadb(fn, n_articles, gse_every, extra_series, timestamp):
+    db = sqlite3.connect(fn)
+    db.executescript(GEOMETADB_SCRIPT)
+    db.execute("insert into metaInfo(name, value) values ('creation timestamp', ?)",
+               (timestamp,))
+
+    series = []
+    samples = []
+    links = []
+    for i in range(0, n_articles, gse_every):
+        n = 100000 + i
+        if not gse_in_metadb(n):
+            continue
+        published = article_date(i)
+        h = spread(n)
+        submitted = published - datetime.timedelta(60 + h % 200)
+        released = published + datetime.timedelta(h % 90 - 30)
+        # the paper GEO links the series to: the one mentioning it, another
+        # one (the mention is then only known from GEOmetadb), one that is
+        # not in PMC, or none yet
+        pmid = [article_pmid(i), article_pmid(i + gse_every), 9000000 + i, None][h // 7 % 4]
+        series.append((n, "Series %d" % n, "GSE%d" % n, geo_status_date(released),
+                       str(submitted), str(released), pmid))
+        for k in range(h // 3 % 4):
+            gsm = "GSM%d%d" % (n, k)
+            samples.append((n, "Sample", gsm, geo_status_date(released + datetime.timedelta(k)),
+                            str(submitted - datetime.timedelta(k)), str(released)))
+            links.append(("GSE%d" % n, gsm))
+        if len(samples) > 100000:
+            db.executemany("insert into gsm values (?, ?, ?, ?, ?, ?)", samples)
+            db.executemany("insert into gse_gsm values (?, ?)", links)
+            samples = []
+            links = []
+    for k in range(extra_series):
+        n = 10000000 + k
+        date = FIRST_DATE + datetime.timedelta(k % 3200)
+        series.append((n, "Series %d" % n, "GSE%d" % n, geo_status_date(date),
+                       str(date), str(date), None))
+    db.executemany("insert into gse values (?, ?, ?, ?, ?, ?, ?)", series)
+    db.executemany("insert into gsm values (?, ?, ?, ?, ?, ?)", samples)
+    db.executemany("insert into gse_gsm values (?, ?)", links)
+    db.commit()
+    db.close()
+
+
+def srx_in_metadb(n):
+    return spread(n) % 2 == 0
+
+
+def srx_web_status(n):
+    return ["public", "private", "removed", "missing"][spread(n) // 2 % 4]
+
+
+def make_srametadb(fn, n_articles, srx_every, timestamp):
+    db = sqlite3.connect(fn)
+    db.executescript("""
+create table sra(experiment_accession TEXT, study_accession TEXT, run_accession TEXT);
+create table metaInfo(name varchar(50), value varchar(50));
+""")
+    db.execute("insert into metaInfo(name, value) values ('creation timestamp', ?)",
+               (timestamp,))
+    db.executemany("insert into sra values (?, ?, ?)",
+                   (("SRX%d" % n, "SRP%d" % n, "SRR%d" % n)
+                    for n in (200000 + i for i in range(0, n_articles, srx_every))
+                    if srx_in_metadb(n)))
+    db.execute("create index sra_experiment_idx on sra(experiment_accession)")
+    db.commit()
+    db.close()
+
+
+def geo_page_date(date):
+    # the series pages put a comma after the day, GEOmetadb does not
+    return "Public on " + date.strftime("%b %d, %Y")
+
+
+def geo_page(gse):
+    n = int(gse[3:])
+    status = gse_web_status(n)
+    if status == "missing":
+        return "<html><body>Could not find a public or private accession \"%s\"</body></html>" % gse
+    if status == "private":
+        return "<html><body>Accession %s is currently private and is scheduled to be released on Jan 01, 2030.</body></html>" % gse
+    released = FIRST_DATE + datetime.timedelta(spread(n) % 3200)
+    return ("<html><body><table><tr><td>Status</td><td>%s</td></tr>\n"
+            "<tr><td nowrap>Title</td>\n<td style=\"text-align: justify\">Series %d</td></tr>"
+            "</table></body></html>" % (geo_page_date(released), n))
+
+
+def sra_efetch(accs):
+    # the text efetch returns for the found accessions of a query
+    parts = []
+    for acc in accs:
+        status = srx_web_status(int(acc[3:]))
+        if status == "public":
+            parts.append("<EXPERIMENT accession=\"%s\"/>" % acc)
+        elif status in ["private", "removed"]:
+            parts.append("<Error>%s is not public</Error>" % acc)
+    return "\n".join(parts)
+
+
+def sra_page(srx):
+    if srx_web_status(int(srx[3:])) == "removed":
+        return "<html><body>Record is removed</body></html>"
+    return "<html><body>%s</body></html>" % srx
@@ -0,0 +1,282 @@
+# Runs the pipeline stages on synthetic fixtures and reports the wall time,
+# throughput and memory of each one as JSON, optionally compared with a
+# baseline report from an earlier run on the same machine. NCBI is replaced
+# by a local stub.
+#
+#   python benchmarks/run_benchmarks.py --articles 10000 --save-baseline
+#   python benchmarks/run_benchmarks.py --articles 10000 --baseline benchmarks/baseline.json
+
+import sys
+import os
+import time
+import json
+import resource
+import sqlite3
+import argparse
+import datetime
+import platform
+import multiprocessing
+from contextlib import contextmanager
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import fixtures
+import stub_ncbi
+
+import parse_papers
+import parse_geometadb
+import GEOCacher
+import SRACacher
+import build_page
+import build_sra
+import instrument
+
+
+FIXTURE_OPTIONS = ["articles", "archives", "gse_every", "srx_every",
+                   "body_size", "extra_series"]
+
+METADB_TIMESTAMP = "2017-03-01 10:00:00"
+
+
+def max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+class Report(object):
+    def __init__(self, config):
+        self.data = {"config": config, "started": str(datetime.datetime.now()),
+                     "python": platform.python_version(),
+                     "machine": platform.node(), "fixtures": {}, "stages": {}}
+
+    @contextmanager
+    def stage(self, name, section="stages"):
+        # the body sets result["items"] to the number of items it processed
+        result = {}
+        start = time.time()
+        yield result
+        seconds = time.time() - start
+        result["seconds"] = round(seconds, 3)
+        if "items" in result:
+            result["items_per_sec"] = round(result["items"] / max(seconds, 1e-6), 1)
+        # ru_maxrss is the peak of the whole run so far, not of this stage:
+        # a stage only shows up when it raises it above the earlier ones
+        result["cumulative_peak_rss_mb"] = round(max_rss_mb(resource.RUSAGE_SELF), 1)
+        result["cumulative_children_peak_rss_mb"] = round(max_rss_mb(resource.RUSAGE_CHILDREN), 1)
+        self.data[section][name] = result
+        print "%-24s %8.2f s" % (name, seconds)
+
+    def save(self, fn):
+        with open(fn, "w") as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+
+
+def fixtures_config(args):
+    config = dict((k, getattr(args, k)) for k in FIXTURE_OPTIONS)
+    config["fixtures_version"] = fixtures.VERSION
+    return config
+
+
+def generate_fixtures(args, report):
+    stamp_fn = os.path.join(args.workdir, "fixtures.json")
+    config = fixtures_config(args)
+    if not args.regenerate and os.path.exists(stamp_fn) and \
+            json.load(open(stamp_fn)) == config:
+        print "Reusing the fixtures in", args.workdir
+        return
+    for dirname in ["rawdata", "metadata", "data", "docs"]:
+        path = os.path.join(args.workdir, dirname)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for fn in os.listdir(path):
+            os.remove(os.path.join(path, fn))
+
+    with report.stage("pmc_archives", "fixtures") as result:
+        fixtures.make_pmc_archives(os.path.join(args.workdir, "rawdata"), args.articles,
+                                   args.archives, args.gse_every, args.srx_every,
+                                   args.body_size, args.jobs)
+        result["items"] = args.articles
+    with report.stage("geometadb", "fixtures"):
+        fixtures.make_geometadb(os.path.join(args.workdir, "metadata/GEOmetadb.sqlite"),
+                                args.articles, args.gse_every, args.extra_series,
+                                METADB_TIMESTAMP)
+    with report.stage("srametadb", "fixtures"):
+        fixtures.make_srametadb(os.path.join(args.workdir, "metadata/SRAmetadb.sqlite"),
+                                args.articles, args.srx_every, METADB_TIMESTAMP)
+    json.dump(config, open(stamp_fn, "w"))
+
+
+def reset_outputs():
+    for fn in ["data/odw.sqlite", "data/cache.sqlite", "data/sra_cache.sqlite"]:
+        if os.path.exists(fn):
+            os.remove(fn)
+    open("whitelist.txt", "w").close()
+
+
+def run_stages(args, report, stub):
+    # relative to the working directory, like the scripts themselves
+    reset_outputs()
+
+    with report.stage("parse_papers") as result:
+        pool = None
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs)
+        dbcon = sqlite3.connect("data/odw.sqlite")
+        if args.bulk_build:
+            parse_papers.setup_bulk_db(dbcon)
+        else:
+            parse_papers.setup_db(dbcon)
+        loader = parse_papers.PaperLoader(dbcon, refresh_derived=not args.bulk_build)
+        for fn in parse_papers.list_archives("rawdata/"):
+            parse_papers.process_tar_to_db(dbcon, fn, pool, max_pending=2 * args.jobs,
+                                           loader=loader)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if args.bulk_build:
+            parse_papers.finish_bulk_db(dbcon)
+        dbcon.close()
+        result["items"] = args.articles
+
+    with report.stage("parse_metadb") as result:
+        metadb = sqlite3.connect("metadata/GEOmetadb.sqlite")
+        dbcon = sqlite3.connect("data/odw.sqlite")
+        all_gse, all_results = parse_geometadb.parse_metadb(metadb)
+        parse_geometadb.merge_attached(dbcon, "metadata/GEOmetadb.sqlite",
+                                       all_gse, all_results)
+        parse_geometadb.update_metadb_stamp(dbcon, metadb)
+        dbcon.close()
+        result["items"] = len(all_gse)
+
+    with report.stage("geo_status") as result:
+        # the series load_dataframes checks on the website, so that it
+        # finds all of them in the cache afterwards
+        dbcon = sqlite3.connect("data/odw.sqlite")
+        gses = [x[0] for x in dbcon.execute("""select distinct acc from mentions where acc_type='GSE'
+                    and acc not in (select acc from datasets where first_public_on is not null)""")]
+        dbcon.close()
+        cache = GEOCacher.GEOCacher("data/cache.sqlite", base_url=stub.geo_url,
+                                    rate=args.http_rate, workers=args.http_workers)
+        cache.check_gse_cached_many(gses)
+        cache.get_geo_records_many(gses, maxlag=99999)
+        result["items"] = len(gses)
+
+    with report.stage("load_dataframes") as result:
+        df_private, df_released, meta_timestamp = build_page.load_dataframes(7)
+        result["items"] = df_private.shape[0] + df_released.shape[0]
+
+    with report.stage("get_hidden_df") as result:
+        combined_df = build_page.combine_old_private(df_released, df_private)
+        build_page.get_hidden_df(combined_df)
+        result["items"] = combined_df.shape[0]
+
+    with report.stage("get_hidden_df_journals") as result:
+        build_page.get_hidden_df(combined_df, by="journal")
+        result["items"] = combined_df.shape[0]
+
+    with report.stage("sra_status") as result:
+        SRACacher.URL_esearch = stub.esearch_url
+        SRACacher.URL_efetch = stub.efetch_url
+        SRACacher.SRA_URL = stub.sra_url
+        sra_db = sqlite3.connect("metadata/SRAmetadb.sqlite")
+        data_db = sqlite3.connect("data/odw.sqlite")
+        cache = SRACacher.SRACacher("data/sra_cache.sqlite", rate=args.http_rate)
+        accs = build_sra.collect_accessions(data_db)
+        build_sra.resolve_status(sra_db, accs, cache)
+        result["items"] = len(accs)
+
+
+def compare(report, baseline, tolerance, min_seconds):
+    # returns the stages that got slower than the baseline by more than
+    # tolerance (a fraction of the baseline time) and min_seconds, short
+    # stages are too noisy to compare by ratio alone
+    if baseline["config"] != report["config"]:
+        print "Warning: the baseline was run with a different configuration"
+    print "%-24s %10s %10s %8s" % ("stage", "baseline", "now", "ratio")
+    regressions = []
+    for (name, result) in sorted(report["stages"].items()):
+        if name not in baseline["stages"]:
+            continue
+        before = baseline["stages"][name]["seconds"]
+        ratio = result["seconds"] / max(before, 1e-3)
+        flag = ""
+        if ratio > 1 + tolerance and result["seconds"] - before > min_seconds:
+            flag = " slower"
+            regressions.append(name)
+        print "%-24s %10.2f %10.2f %8.2f%s" % (name, before, result["seconds"], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the datawatch pipeline on synthetic data')
+
+    parser.add_argument("--articles", type=int, default=10000)
+    parser.add_argument("--archives", type=int, default=4)
+    parser.add_argument("--gse-every", type=int, default=20,
+                        help="one article in this many deposits a GEO series")
+    parser.add_argument("--srx-every", type=int, default=50,
+                        help="one article in this many mentions an SRA experiment")
+    parser.add_argument("--body-size", type=int, default=20000,
+                        help="approximate length of an article body in bytes")
+    parser.add_argument("--extra-series", type=int, default=10000,
+                        help="series in GEOmetadb that no article mentions")
+    parser.add_argument("--workdir", default=os.path.join(BENCH_DIR, "work"))
+    parser.add_argument("--regenerate", action="store_true",
+                        help="generate the fixtures even if they match the options")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--bulk-build", action="store_true")
+    parser.add_argument("--http-rate", type=float, default=1000,
+                        help="requests per second allowed against the stub")
+    parser.add_argument("--http-workers", type=int, default=4)
+    parser.add_argument("--output", default="",
+                        help="file to write the report to, "
+                        "<workdir>/report.json by default")
+    parser.add_argument("--baseline", default="",
+                        help="report to compare the stage times with")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="also store the report as benchmarks/baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="slowdown over the baseline reported as a regression")
+    parser.add_argument("--min-seconds", type=float, default=0.5,
+                        help="smallest slowdown in seconds reported as a regression")
+
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir)
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+    output = os.path.abspath(args.output or os.path.join(args.workdir, "report.json"))
+
+    config = fixtures_config(args)
+    config.update({"jobs": args.jobs, "bulk_build": args.bulk_build})
+    report = Report(config)
+    generate_fixtures(args, report)
+
+    stub = stub_ncbi.StubNCBI()
+    stub.start()
+    cwd = os.getcwd()
+    os.chdir(args.workdir)
+    try:
+        run_stages(args, report, stub)
+    finally:
+        os.chdir(cwd)
+        stub.stop()
+
+    metrics = instrument.metrics.report()
+    for key in ["counters", "cache_hit_rates", "histograms", "sqlite_queries"]:
+        report.data[key] = metrics[key]
+    report.save(output)
+    print "Report written to", output
+    if args.save_baseline:
+        report.save(os.path.join(BENCH_DIR, "baseline.json"))
+
+    if args.baseline != "":
+        regressions = compare(report.data, json.load(open(args.baseline)),
+                              args.tolerance, args.min_seconds)
+        if len(regressions) > 0:
+            print "Slower than the baseline:", ", ".join(regressions)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Local stand-in for the NCBI endpoints used by GEOCacher and SRACacher,
+# answering from the fixture rules so that the benchmarks run offline.
+
+import BaseHTTPServer
+import SocketServer
+import threading
+import urlparse
+import json
+import itertools
+
+import fixtures
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="text/html"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == "/geo/query/acc.cgi":
+            self.reply(fixtures.geo_page(query["acc"][0]))
+        elif url.path == "/sra/":
+            self.reply(fixtures.sra_page(query["term"][0]))
+        elif url.path == "/entrez/eutils/efetch.fcgi":
+            accs = self.server.searches[query["webenv"][0]]
+            self.reply(fixtures.sra_efetch(accs), "text/xml")
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != "/entrez/eutils/esearch.fcgi":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        term = urlparse.parse_qs(body)["term"][0]
+        accs = [acc.replace("[accn]", "").strip() for acc in term.split(" OR ")]
+        found = [acc for acc in accs
+                 if fixtures.srx_web_status(int(acc[3:])) != "missing"]
+        result = {"count": str(len(found))}
+        if len(found) > 0:
+            webenv = "stub_%d" % next(self.server.counter)
+            self.server.searches[webenv] = found
+            result.update({"querykey": "1", "webenv": webenv})
+        self.reply(json.dumps({"esearchresult": result}), "application/json")
+
+
+class StubNCBI(object):
+    def __init__(self):
+        self.server = StubServer(("127.0.0.1", 0), StubHandler)
+        self.server.searches = {}
+        self.server.counter = itertools.count()
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.geo_url = self.base_url + "/geo/query/acc.cgi?acc="
+        self.sra_url = self.base_url + "/sra/?term="
+        self.esearch_url = self.base_url + "/entrez/eutils/esearch.fcgi"
+        self.efetch_url = self.base_url + "/entrez/eutils/efetch.fcgi"
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,5 +1,3 @@
-import sqlite3
-import re
 import argparse
 import json
 import datetime
@@ -9,45 +7,74 @@ mpl.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import seaborn as sns
-from dateutil.parser import parse
-import tqdm
 
 import GEOCacher
+import accessions
+import derived_tables
+import instrument
 
 
 def combine_old_private(df_old, df_private):
-    df1 = df_old[["gse", "first_mentioned", "released"]]
+    df1 = df_old[["gse", "first_mentioned", "released", "journal_nlm"]]
+    df1 = df1.rename(columns={"journal_nlm": "journal"})
     df2 = df_private[["gse"]]
     df2.loc[:, "first_mentioned"] = df_private["published_on"]
     df2.loc[:, "released"] = [None] * (df_private.shape[0])
+    df2.loc[:, "journal"] = df_private["journal"]
     return pd.concat([df1, df2])
 
 
-prepare_temp_tables = """
-CREATE temp table  first_mention  as
-    select m.acc, p.paperid
-        from mentions m, papers p
-           where m.paperid = p.paperid and p.published_on =
-                (select min(published_on) from papers p, mentions m0 where p.paperid=m0.paperid and m0.acc = m.acc);
-
-CREATE index temp.first_mention_acc_idx on first_mention(acc);
+def reconcile_statuses(df_released, df_missing, cache, maxlag, skip_gses):
+    # Checks the GEO status of the GSEs that GEOmetadb does not know as
+    # released: the ones in df_missing, except those in skip_gses, and the
+    # ones in df_released without a release date. Returns the frame of the
+    # private ones and df_released extended with the ones GEO lists as public.
+    skip_gses = set(skip_gses)
+
+    unreleased = df_released.released.isnull().values
+    df_unreleased = df_released[unreleased]
+    df_released = df_released[~unreleased]
+
+    to_check = list(df_unreleased.gse) + [gse for gse in df_missing.gse
+                                          if gse not in skip_gses]
+    statuses = accessions.resolve_statuses("GSE", to_check, maxlag, cache)
+
+    # GSEs in GEOmetadb without a release date that GEO still lists as private
+    # isin() instead of ==, which gives a scalar False on empty frames
+    df_weird = df_unreleased[df_unreleased.gse.map(statuses).isin(["private"]).values]
+    for gse in df_weird.gse:
+        print "Weird GSE: ", gse
+    df_weird = pd.DataFrame({"gse": df_weird.gse, "published_on": df_weird.first_mentioned,
+                             "journal": df_weird.journal_nlm, "doi": df_weird.doi,
+                             "title": df_weird.title})
+    df_missing = pd.concat([df_missing, df_weird[df_missing.columns]], ignore_index=True)
+
+    missing_statuses = pd.Series([("skip" if gse in skip_gses else statuses[gse])
+                                  for gse in df_missing.gse], dtype=object)
+
+    df_present = df_missing[missing_statuses.isin(["present"]).values]
+    records = cache.get_geo_records_many(df_present.gse, maxlag=99999)
+    reldates = df_present.gse.map(lambda gse: records[gse]["public_on"])
+    for gse in df_present.gse[reldates.isnull().values]:
+        print "Failed to extract date for ", gse
+    df_new = pd.DataFrame({"gse": df_present.gse, "doi": df_present.doi, "title": df_present.title,
+                           "submitted": None, "first_mentioned": df_present.published_on,
+                           "released": reldates, "journal_nlm": df_present.journal})
+    df_new = df_new[reldates.notnull().values]
+    df_released = pd.concat([df_released, df_new[df_released.columns]], ignore_index=True)
+
+    df_private = df_missing[missing_statuses.isin(["private"]).values]
+    df_private = df_private.sort_values("published_on")
 
-CREATE temp table gse_times  AS
-  select ds.acc, ds.first_submitted_on as submitted, ds.first_public_on as released, p.published_on as first_mentioned, ds.title, m.paperid as first_paper
-  from datasets ds
-        left join first_mention m on m.acc = ds.acc
-        left join papers p on p.paperid = m.paperid where m.acc GLOB 'GSE*';
-"""
+    return df_private, df_released
 
 
 def load_dataframes(maxlag):
     print "Loading data..."
-    data_db = sqlite3.connect("data/odw.sqlite")
+    data_db = instrument.connect("data/odw.sqlite")
 
     cache = GEOCacher.GEOCacher("data/cache.sqlite")
-    print "Preparing extra tables...  ",
-    data_db.executescript(prepare_temp_tables)
-    print "done"
+    derived_tables.ensure_derived_tables(data_db)
 
     query_released = """
     select acc as gse, doi, papers.title, submitted, first_mentioned, released, journal_nlm from gse_times, papers
@@ -59,54 +86,15 @@ def load_dataframes(maxlag):
     query_private = """select distinct acc as gse, published_on, journal_nlm as journal,
                     doi, title from mentions, papers
                         where gse not in (select acc from datasets) and mentions.paperid=papers.paperid
-                        and mentions.acc GLOB 'GSE*'
+                        and mentions.acc_type = 'GSE'
                         order by published_on asc"""
     df_missing = pd.read_sql_query(query_private, data_db)
 
     skip_gses = map(lambda x: x.split()[0], open("whitelist.txt").readlines())
 
     print "Double-checking missing GSE's using NCBI website..."
-
-    statuses_released = []
-    for (i, gse) in enumerate(tqdm.tqdm(df_released.gse)):
-        if df_released.released[i] is None:
-            status = cache.check_gse_cached(gse, maxlag=maxlag)
-            statuses_released.append(False)
-            if status == "private":  # append it to df_missing then
-                # Index([u'gse', u'published_on', u'journal', u'doi', u'title'], dtype='object')
-                df_missing = df_missing.append({"gse": gse, "published_on": df_released.first_mentioned[i], "journal": df_released.journal_nlm[i],
-                                                "doi": df_released.doi[i], "title": df_released.title[i]}, ignore_index=True)
-                print "Weird GSE: ", gse
-
-        else:
-            statuses_released.append(True)
-
-    nonreleased = np.nonzero(np.invert(np.array(statuses_released)))[0]
-    # print "Missing GSEs that are mentioned in GEOMetadb :",
-    # df_released.gse[nonreleased]
-    df_released = df_released.ix[np.nonzero(statuses_released)[0]]
-
-    today_str = str(datetime.date.today())
-    statuses = []
-    for (i, gse) in enumerate(tqdm.tqdm(df_missing.gse)):
-        if gse in skip_gses:
-            statuses.append("skip")
-        else:
-            status = cache.check_gse_cached(gse, maxlag=maxlag)
-            if status == "present":
-                data = cache.get_geo_page(gse, maxlag=99999)
-                reldate = re.search("Public on (.*)<", data)
-                if reldate is None:
-                    print "Failed to extract date for ", gse
-                    reldate = today_str
-                else:
-                    reldate = reldate.group(1)
-                    df_released = df_released.append({"doi": df_missing.gse[i], "gse": gse, "submitted" : None, "title": df_missing.title[i], "journal_nlm": df_missing.journal[
-                                                 i], "first_mentioned": df_missing.published_on[i],  "released": reldate}, ignore_index=True)
-            statuses.append(status)
-
-    df_private = df_missing.ix[np.array(statuses) == "private"]
-    df_private = df_private.sort_values("published_on")
+    df_private, df_released = reconcile_statuses(df_released, df_missing, cache,
+                                                 maxlag, skip_gses)
 
     cur = data_db.execute(
         "select value from metadata where name = 'GEOmetadb timestamp'")
@@ -115,27 +103,46 @@ def load_dataframes(maxlag):
     return df_private, df_released, meta_timestamp
 
 
-def get_hidden_df(df):
-    df = df.copy()
-    oneday = datetime.timedelta(1)
-    timestep = datetime.timedelta(3)
-    x = []
-    y = []
-    c = datetime.date.today() - oneday
-    mentioned = np.array(map(lambda x: parse(x).date(), df.first_mentioned))
+def to_days(values):
+    return pd.to_datetime(values).values.astype("datetime64[D]")
+
+
+def count_overdue(mentioned, public, dates):
+    # A dataset is overdue on day c if mentioned < c and public > c + 1 day,
+    # i.e. while c is inside (mentioned, public - 1 day). For non-empty
+    # intervals the number containing c is #(start < c) - #(end <= c), so
+    # sorting both ends once is enough to count any number of dates.
+    end = public - np.timedelta64(1, "D")
+    keep = ~(pd.isnull(mentioned) | pd.isnull(end))
+    keep[keep] = mentioned[keep] < end[keep]
+    starts = np.sort(mentioned[keep])
+    ends = np.sort(end[keep])
+    return (np.searchsorted(starts, dates, side="left") -
+            np.searchsorted(ends, dates, side="right"))
+
+
+def get_hidden_df(df, step=3, by=None):
+    # overdue counts every `step` days going back from yesterday to 2008,
+    # and one extra column per value of the `by` column if it is given
+    last = np.datetime64(datetime.date.today() - datetime.timedelta(1), "D")
+    n_dates = (last - np.datetime64("2008-01-01", "D")).astype(int) // step + 1
+    dates = last - np.arange(n_dates) * np.timedelta64(step, "D")
+
+    mentioned = to_days(df.first_mentioned)
     filldate = (datetime.datetime.today() + datetime.timedelta(1)).date()
-    public = np.array(map(lambda x: parse(x).date(),
-                          df.released.fillna(str(filldate))))
-    while c >= datetime.date(2008, 1, 1):
-        mask1 = mentioned < c
-        mask2 = public > c + oneday
-        x.append(c)
-        y.append(np.count_nonzero(mask1 & mask2))
-        c -= timestep
+    public = to_days(df.released.fillna(str(filldate)))
 
-    print "Current overdue: ", y[0]
+    result = pd.DataFrame({"date": pd.to_datetime(dates).date,
+                           "overdue": count_overdue(mentioned, public, dates)})
+    if by is not None:
+        groups = df[by].fillna("").values
+        for value in sorted(set(groups)):
+            mask = groups == value
+            result[value] = count_overdue(mentioned[mask], public[mask], dates)
 
-    return pd.DataFrame({"date": x, "overdue": y})
+    print "Current overdue: ", result.overdue[0]
+
+    return result
 
 
 def update_graph(dff):
@@ -143,7 +150,7 @@ def update_graph(dff):
     sns.set_style("ticks")
 
     sns.set_context("talk")
-    dff.ix[::10].plot("date", "overdue", figsize=(7, 4), lw=3)
+    dff.iloc[::10].plot("date", "overdue", figsize=(7, 4), lw=3)
     onemonth = datetime.timedelta(30)
     plt.xlim(dff.date.min(), dff.date.max()+onemonth)
     plt.ylabel("Overdue dataset")
@@ -210,22 +217,37 @@ def main():
 
     parser.add_argument("--maxlag", default=7)
     parser.add_argument("--output", default="")
+    parser.add_argument("--graph-step", type=int, default=3,
+                        help="days between the points of the overdue graph")
+    parser.add_argument("--by-journal", action="store_true",
+                        help="also write the overdue counts of every journal "
+                        "to <output>_graph_journals.csv")
+    instrument.add_arguments(parser)
 
     args = parser.parse_args()
+    instrument.configure(args)
 
-
-    df_private, df_released, meta_timestamp = load_dataframes(args.maxlag)
+    with instrument.stage("load_dataframes") as stage:
+        df_private, df_released, meta_timestamp = load_dataframes(args.maxlag)
+        stage["items"] = df_private.shape[0] + df_released.shape[0]
     combined_df = combine_old_private(df_released, df_private)
     print "Currently missing entries in GEOMetadb: ", df_private.shape[0]
-    graph_df = get_hidden_df(combined_df)
+    with instrument.stage("get_hidden_df") as stage:
+        graph_df = get_hidden_df(combined_df, args.graph_step)
+        stage["items"] = combined_df.shape[0]
     if args.output != "":
         combined_df.to_csv(args.output + "_combined.csv", encoding='utf-8')
         df_released.to_csv(args.output + "_released.csv", encoding='utf-8')
         graph_df.to_csv(args.output + "_graph.csv", encoding='utf-8')
-
-    prepare_data_json(df_private, meta_timestamp, str(datetime.date.today()))
-    update_html(df_private, meta_timestamp)
-    update_graph(graph_df)
+        if args.by_journal:
+            journals_df = get_hidden_df(combined_df, args.graph_step, by="journal")
+            journals_df.to_csv(args.output + "_graph_journals.csv", encoding='utf-8')
+
+    with instrument.stage("render"):
+        prepare_data_json(df_private, meta_timestamp, str(datetime.date.today()))
+        update_html(df_private, meta_timestamp)
+        update_graph(graph_df)
+    instrument.finish(args)
 
 if __name__ == "__main__":
     main()
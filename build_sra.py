@@ -1,65 +1,26 @@
 import pandas as pd
-import matplotlib as mpl
-mpl.use('Agg')
-import matplotlib.pyplot as plt
-import numpy as np
 import datetime
-import seaborn as sns
-from dateutil.parser import parse
-import tqdm
-import sqlite3
-import re
 import argparse
 import json
 
-import GEOCacher
+import SRACacher
+import accessions
+import instrument
 
 
-sraDB = sqlite3.connect("metadata/SRAmetadb.sqlite")
+def get_known_srxs(sra_db, srxs):
+    # all of the given accessions that SRAmetadb has, in one query
+    sra_db.execute("create temp table if not exists query_accs(acc text primary key)")
+    sra_db.execute("delete from temp.query_accs")
+    sra_db.executemany("insert or ignore into temp.query_accs(acc) values (?)",
+                       ((srx,) for srx in srxs))
+    cur = sra_db.execute("""select distinct experiment_accession from sra
+                            where experiment_accession in (select acc from temp.query_accs)""")
+    return set(x[0] for x in cur.fetchall())
 
-dataDB = sqlite3.connect("data/odw.sqlite")
 
-def get_srx(srx):
-    return sraDB.execute("select * from sra where experiment_accession=?", (srx,)).fetchall()
-
-# %%
-
-
-SRA_accs = dataDB.execute("select distinct acc from mentions where acc like 'SRX%'").fetchall()
-SRA_accs = map(lambda x: x[0], SRA_accs)
-
-
-
-
-
-import urllib2, json, requests
-
-URL_esearch = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi"
-URL_efetch = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
-
-def get_data_about_accessions(db, accs):
-    req_str = "db=" + db + "&retmode=json&retmax=50000&usehistory=y&term=" + "+OR+".join(map(lambda x: x + "[accn]", accs))
-    resp = requests.post(URL_esearch, data=req_str)
-    jdata = json.loads(resp.content)["esearchresult"]
-    qkey = jdata["querykey"]
-    webenv = jdata["webenv"]
-
-    resp2 = requests.get(URL_efetch, {"db" : db, "query_key" : qkey, "webenv" : webenv, "email" : "grechkin@cs.washington.edu"})
-
-    return resp2.content
-
-def srx_not_public(srx):
-    resp = requests.get(URL_esearch, {"email" : "grechkin@cs.washington.edu", "retmode" : "json", "db" : "sra", "term" : srx, "retmax" : 50, "usehistory" : "y"})
-
-    jdata = json.loads(resp.content)["esearchresult"]
-    qkey = jdata["querykey"]
-    webenv = jdata["webenv"]
-
-    resp2 = requests.get(URL_efetch, {"db" : "sra", "query_key" : qkey, "webenv" : webenv, "email" : "grechkin@cs.washington.edu"})
-    return (srx + " is not public") in resp2.content.decode("utf-8")
-
-#SRA_overdue1 = filter(lambda x: len(get_srx(x)) == 0, SRA_accs)
-#SRA_overdue2 = filter(srx_not_public, SRA_overdue1)
+def get_sradb_timestamp(sra_db):
+    return sra_db.execute("select value from metaInfo where name='creation timestamp'").fetchall()[0][0]
 
 
 def srx2url(srx):
@@ -85,36 +46,31 @@ def format_srx(srx):
 def format_paper(pmid):
     return """<a href="%s">paper</a>""" % (pmid2url(pmid))
 
-import urllib2
-def check_is_removed(srx):
-    srxurl = srx2url(srx)
-    data = urllib2.urlopen(srxurl).read()
-    return "Record is removed" in data
 
+def collect_accessions(data_db):
+    accessions.ensure_acc_type(data_db)
+    return accessions.mentioned_accessions(data_db, "SRX")
 
-#SRA_overdue2_removed = filter(check_is_removed, SRA_overdue2)
 
+def resolve_status(sra_db, accs, cache, maxlag=7):
+    # the accessions that are neither in SRAmetadb nor public on NCBI
+    known = get_known_srxs(sra_db, accs)
+    statuses = accessions.resolve_statuses("SRX", [x for x in accs if x not in known],
+                                           maxlag, cache)
+    return [x for x in accs if statuses.get(x) == "private"]
 
-#SRA_overdue2_kept = np.setdiff1d(SRA_overdue2, SRA_overdue2_removed)
 
+def get_paper(data_db, srx):
+    return data_db.execute("select * from papers, mentions where acc=? and mentions.paperid=papers.paperid", (srx,)).fetchall()
 
-SRA_overdue = []
-for x in tqdm.tqdm(SRA_accs):
-    if (len(get_srx(x)) == 0) and srx_not_public(x) and (not (check_is_removed(x))):
-        SRA_overdue.append(x)
 
-
-def get_paper(srx):
-    return dataDB.execute("select * from papers, mentions where acc=? and mentions.paperid=papers.paperid", (srx,)).fetchall()
-
-
-def get_df(accs):
+def build_dataframe(data_db, accs):
     title = []
     doi = []
     published_on = []
     journal = []
     for srx in accs:
-        paper = get_paper(srx)[0]
+        paper = get_paper(data_db, srx)[0]
         title.append(paper[1])
         doi.append(paper[2])
         published_on.append(paper[5])
@@ -157,9 +113,6 @@ def update_html(df, sradb_timestamp):
 
 
 
-SRATIMESTAMP = sraDB.execute("select value from metaInfo where name='creation timestamp'").fetchall()[0][0]
-
-
 def prepare_data_json(df_private, meta_timestamp, update_date):
     result = dict()
     result["meta_timestamp"] = meta_timestamp
@@ -168,6 +121,41 @@ def prepare_data_json(df_private, meta_timestamp, update_date):
     json.dump(result, open("private_sra.json", "w"))
 
 
-df = get_df(SRA_overdue)
-update_html(df, SRATIMESTAMP)
-prepare_data_json(df, SRATIMESTAMP, str(datetime.date.today()))
+def render(df, sradb_timestamp):
+    update_html(df, sradb_timestamp)
+    prepare_data_json(df, sradb_timestamp, str(datetime.date.today()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the SRA page for datawatch')
+
+    parser.add_argument("--maxlag", type=int, default=7)
+    parser.add_argument("--sradb", default="metadata/SRAmetadb.sqlite")
+    parser.add_argument("--cache", default="data/sra_cache.sqlite")
+    parser.add_argument("--resolve-only", action="store_true",
+                        help="only refresh the cached SRX statuses")
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    instrument.configure(args)
+
+    sra_db = instrument.connect(args.sradb)
+    data_db = instrument.connect("data/odw.sqlite")
+    cache = SRACacher.SRACacher(args.cache)
+
+    with instrument.stage("collect_accessions") as stage:
+        accs = collect_accessions(data_db)
+        stage["items"] = len(accs)
+    with instrument.stage("resolve_status") as stage:
+        overdue = resolve_status(sra_db, accs, cache, args.maxlag)
+        stage["items"] = len(accs)
+    print "Overdue SRX: ", len(overdue)
+    if not args.resolve_only:
+        with instrument.stage("render") as stage:
+            df = build_dataframe(data_db, overdue)
+            render(df, get_sradb_timestamp(sra_db))
+            stage["items"] = len(overdue)
+    instrument.finish(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import accessions
+
+# first_mention holds, for every accession, the mentions from its earliest
+# published paper(s). parse_papers and parse_geometadb update the rows of
+# the accessions they add mentions for, so that building the pages does
+# not have to derive it again.
+CREATE_SCRIPT = """
+create table if not exists first_mention(acc text not null, paperid int not null, acc_type text);
+create index if not exists first_mention_acc_idx on first_mention(acc);
+"""
+
+GSE_TIMES_VIEW = """create view gse_times AS
+  select ds.acc, ds.first_submitted_on as submitted, ds.first_public_on as released, p.published_on as first_mentioned, ds.title, m.paperid as first_paper
+  from datasets ds
+        left join first_mention m on m.acc = ds.acc
+        left join papers p on p.paperid = m.paperid where m.acc_type = 'GSE'"""
+
+# row of the metadata table recording that first_mention was built in full
+BUILT_MARKER = "first_mention built"
+
+FIRST_MENTION_QUERY = """
+insert into first_mention(acc, paperid, acc_type)
+    select m.acc, m.paperid, m.acc_type
+        from mentions m, papers p,
+            (select m0.acc, min(p0.published_on) as published_on
+                from mentions m0, papers p0
+                where p0.paperid = m0.paperid %s
+                group by m0.acc) f
+        where m.paperid = p.paperid and m.acc = f.acc and p.published_on = f.published_on
+"""
+
+
+def setup_derived_tables(dbcon):
+    accessions.ensure_acc_type(dbcon)
+    dbcon.execute("create table if not exists metadata(name text unique, value text)")
+    columns = [row[1] for row in dbcon.execute("pragma table_info(first_mention)")]
+    if len(columns) > 0 and "acc_type" not in columns:
+        # built before acc_type existed
+        dbcon.execute("drop table first_mention")
+        dbcon.execute("delete from metadata where name=?", (BUILT_MARKER,))
+    dbcon.executescript(CREATE_SCRIPT)
+    # only replaced when its definition changed, so that readers such as
+    # build_page do not write to the database; sqlite stores the statement
+    # with the CREATE VIEW keywords uppercased
+    view = dbcon.execute(
+        "select sql from sqlite_master where type='view' and name='gse_times'").fetchall()
+    if len(view) == 0 or view[0][0].lower() != GSE_TIMES_VIEW.lower():
+        dbcon.execute("drop view if exists gse_times")
+        dbcon.execute(GSE_TIMES_VIEW)
+        dbcon.commit()
+    # the incremental updates only keep the rows of the accessions they
+    # touch, the whole table is built once when it is new (or was built
+    # before the marker existed) on a database that already has mentions
+    built = dbcon.execute("select count(*) from metadata where name=?",
+                          (BUILT_MARKER,)).fetchone()[0] > 0
+    if not built:
+        rebuild_first_mention(dbcon)
+        dbcon.commit()
+
+
+def rebuild_first_mention(dbcon):
+    dbcon.execute("delete from first_mention")
+    dbcon.execute(FIRST_MENTION_QUERY % "")
+    dbcon.execute("insert or replace into metadata(name, value) values (?, datetime('now'))",
+                  (BUILT_MARKER,))
+
+
+def refresh_first_mention(dbcon, accs):
+    # recompute the rows of the given accessions only
+    dbcon.execute("create temp table if not exists refresh_accs(acc text primary key)")
+    dbcon.execute("delete from temp.refresh_accs")
+    dbcon.executemany("insert or ignore into temp.refresh_accs(acc) values (?)",
+                      ((acc,) for acc in accs))
+    dbcon.execute(
+        "delete from first_mention where acc in (select acc from temp.refresh_accs)")
+    dbcon.execute(FIRST_MENTION_QUERY %
+                  "and m0.acc in (select acc from temp.refresh_accs)")
+
+
+def ensure_derived_tables(dbcon):
+    # databases built before first_mention existed get it on first use
+    setup_derived_tables(dbcon)
@@ -0,0 +1,212 @@
+# Run metrics shared by the pipeline scripts: wall time and throughput of
+# the stages, counters (e.g. cache hits and misses), latency histograms of
+# the HTTP requests and the number of sqlite statements. The scripts write
+# them as a JSON report with --report, and --profile runs the named stages
+# under cProfile (or pyinstrument if it is installed and asked for).
+
+import sqlite3
+import time
+import datetime
+import json
+import sys
+import os
+import threading
+import collections
+import cProfile
+from contextlib import contextmanager
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Histogram(object):
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        n = sum(self.counts)
+        buckets = collections.OrderedDict(
+            ("<=%g" % bound, count) for (bound, count) in zip(self.bounds, self.counts))
+        buckets[">%g" % self.bounds[-1]] = self.counts[-1]
+        return {"count": n, "mean": self.total / n if n > 0 else None,
+                "max": self.maximum, "buckets": buckets}
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+        self.queries = 0
+        self.profile_stages = set()
+        self.profiler = "cprofile"
+        self.profile_dir = "."
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value, bounds=LATENCY_BUCKETS):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(bounds)
+            self.histograms[name].add(value)
+
+    def count_query(self):
+        # no lock, statements are only counted on the thread owning the
+        # connection and an occasional lost increment does not matter
+        self.queries += 1
+
+    @contextmanager
+    def stage(self, name):
+        # the body can set stage["items"] to the number of items it processed
+        stage = collections.OrderedDict([("name", name)])
+        queries = self.queries
+        profiler = self._start_profiler(name)
+        start = time.time()
+        try:
+            yield stage
+        finally:
+            stage["seconds"] = round(time.time() - start, 3)
+            self._stop_profiler(name, profiler)
+            stage["queries"] = self.queries - queries
+            if "items" in stage:
+                stage["items_per_sec"] = round(
+                    stage["items"] / max(stage["seconds"], 1e-3), 1)
+            self.stages.append(stage)
+
+    def _profile_filename(self, name, ext):
+        safe = "".join(c if c.isalnum() else "_" for c in name)
+        return os.path.join(self.profile_dir, safe + ext)
+
+    def _start_profiler(self, name):
+        if name not in self.profile_stages:
+            return None
+        if self.profiler == "pyinstrument":
+            profiler = pyinstrument.Profiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, name, profiler):
+        if profiler is None:
+            return
+        if self.profiler == "pyinstrument":
+            profiler.stop()
+            with open(self._profile_filename(name, ".txt"), "w") as f:
+                f.write(profiler.output_text().encode("utf-8"))
+        else:
+            profiler.disable()
+            profiler.dump_stats(self._profile_filename(name, ".prof"))
+
+    def cache_rates(self):
+        # hit rate of every counter pair <name>.hit / <name>.miss
+        rates = {}
+        for name in self.counters:
+            if name.endswith(".hit"):
+                prefix = name[:-len(".hit")]
+                hits = self.counters[name]
+                total = hits + self.counters.get(prefix + ".miss", 0)
+                rates[prefix] = round(float(hits) / total, 4) if total > 0 else None
+        return rates
+
+    def report(self):
+        return collections.OrderedDict([
+            ("command", " ".join(sys.argv)),
+            ("started", str(self.started)),
+            ("seconds", round((datetime.datetime.now() - self.started).total_seconds(), 3)),
+            ("stages", self.stages),
+            ("counters", dict(self.counters)),
+            ("cache_hit_rates", self.cache_rates()),
+            ("histograms", dict((name, h.to_dict()) for (name, h) in self.histograms.items())),
+            ("sqlite_queries", self.queries)])
+
+    def write_report(self, fn):
+        with open(fn, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+metrics = Metrics()
+
+
+def stage(name):
+    return metrics.stage(name)
+
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+
+def observe(name, value):
+    metrics.observe(name, value)
+
+
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        metrics.count_query()
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, *args):
+        metrics.count_query()
+        return sqlite3.Cursor.executemany(self, *args)
+
+    def executescript(self, *args):
+        metrics.count_query()
+        return sqlite3.Cursor.executescript(self, *args)
+
+
+class CountingConnection(sqlite3.Connection):
+    # the execute shortcuts of the connection go through cursor() as well
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+
+def connect(filename, **kwargs):
+    return sqlite3.connect(filename, factory=CountingConnection, **kwargs)
+
+
+def add_arguments(parser):
+    parser.add_argument("--report", default="",
+                        help="write the stage timings and counters to this JSON file")
+    parser.add_argument("--profile", default="",
+                        help="comma separated stages to profile, "
+                        "the profiles are written next to the report")
+    parser.add_argument("--profiler", choices=["cprofile", "pyinstrument"],
+                        default="cprofile")
+
+
+def configure(args):
+    if args.profile != "":
+        metrics.profile_stages = set(args.profile.split(","))
+    if args.profiler == "pyinstrument" and pyinstrument is None:
+        raise ValueError("pyinstrument is not installed")
+    metrics.profiler = args.profiler
+    if args.report != "":
+        metrics.profile_dir = os.path.dirname(os.path.abspath(args.report))
+
+
+def finish(args):
+    if args.report != "":
+        metrics.write_report(args.report)
+        print "Run report written to", args.report
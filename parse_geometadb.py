@@ -1,72 +1,93 @@
 # coding: utf-8
 
-import sqlite3
 import datetime
+import argparse
+import hashlib
 import dateutil.parser
 import tqdm
 
+import derived_tables
+import instrument
 
-def parse_date(s):
-    s = s.replace("Public on ", "")
-    return dateutil.parser.parse(s).date()
 
+GEO_MONTHS = dict((m, i + 1) for (i, m) in enumerate(
+    ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]))
 
-def get_date_by_query(metadb, query, gse):
-    cur = metadb.cursor()
-    cur.execute(query, (gse,))
-    values = map(lambda x: parse_date(x[0]), cur.fetchall())
-    cur.close()
-    if len(values) > 0:
-        return min(values)
-    else:
-        return None
+# the same few thousand date strings repeat over all of the samples
+parsed_dates = {}
 
 
-def get_released_date(metadb, gse):
-    query = "select distinct status from gsm, gse_gsm where gsm.gsm = gse_gsm.gsm and gse_gsm.gse = ?"
-    result = get_date_by_query(metadb, query, gse)
-    if result is None:
-        query2 = "select status from gse where gse=?"
-        return get_date_by_query(metadb, query2, gse)
-    else:
-        return result
+def parse_geo_date(s):
+    # GEOmetadb only uses "Mar 07 2012" (after "Public on ") and "2012-03-07"
+    try:
+        parts = s.split()
+        if len(parts) == 3 and parts[0] in GEO_MONTHS:
+            return datetime.date(int(parts[2]), GEO_MONTHS[parts[0]], int(parts[1]))
+        if len(s) == 10 and s[4] == "-" and s[7] == "-":
+            return datetime.date(int(s[:4]), int(s[5:7]), int(s[8:]))
+    except ValueError:
+        pass
+    return None
 
 
-def get_submitted_date(metadb, gse):
-    query = ("select distinct submission_date as date from gsm, gse_gsm where " +
-             " gse_gsm.gsm = gsm.gsm and gse_gsm.gse = ? group by submission_date")
-    return get_date_by_query(metadb, query, gse)
+def parse_date(s):
+    s = s.replace("Public on ", "")
+    result = parsed_dates.get(s)
+    if result is None:
+        result = parse_geo_date(s)
+        if result is None:
+            result = dateutil.parser.parse(s).date()
+        parsed_dates[s] = result
+    return result
 
 
-def get_pmid(metadb, gse):
-    cur = metadb.cursor()
-    cur.execute("select pubmed_id from gse where gse=?", (gse, ))
-    data = cur.fetchall()
+def get_min_dates(metadb, query):
+    # query returns (gse, date string) rows, keeps the earliest date of each gse
+    result = {}
+    cur = metadb.execute(query)
+    for (gse, value) in cur:
+        date = parse_date(value)
+        if gse not in result or date < result[gse]:
+            result[gse] = date
     cur.close()
-    return data[0][0]
+    return result
 
 
-def get_title(metadb, gse):
-    cur = metadb.cursor()
-    cur.execute("select title from gse where gse=?", (gse, ))
-    data = cur.fetchall()
-    cur.close()
-    return data[0][0]
+def select_gses(metadb, gses):
+    metadb.execute("create temp table if not exists selected_gse(gse text primary key)")
+    metadb.execute("delete from temp.selected_gse")
+    metadb.executemany("insert into temp.selected_gse(gse) values (?)",
+                       ((gse,) for gse in gses))
 
 
-def parse_metadb(metadb):
+def parse_metadb(metadb, gses=None):
+    # the earliest sample release and submission dates, the pubmed id and
+    # the title of every series, computed with one grouped pass over each
+    # table. If gses is given, only those series are parsed.
+    sample_filter = ""
+    series_filter = ""
+    if gses is not None:
+        select_gses(metadb, gses)
+        sample_filter = " and gse_gsm.gse in (select gse from temp.selected_gse)"
+        series_filter = " where gse in (select gse from temp.selected_gse)"
 
-    cur = metadb.cursor()
-    cur.execute("select gse from gse")
-    all_gse = map(lambda x: x[0], cur.fetchall())
+    released = get_min_dates(metadb, """select distinct gse_gsm.gse, gsm.status from gsm, gse_gsm
+                                     where gsm.gsm = gse_gsm.gsm""" + sample_filter)
+    submitted = get_min_dates(metadb, """select distinct gse_gsm.gse, gsm.submission_date from gsm, gse_gsm
+                                      where gse_gsm.gsm = gsm.gsm""" + sample_filter)
 
+    all_gse = []
     all_results = {}
-    for gse in tqdm.tqdm(all_gse):
-        released = get_released_date(metadb, gse)
-        submitted = get_submitted_date(metadb, gse)
-        pmid = get_pmid(metadb, gse)
-        title = get_title(metadb, gse)
-        all_results[gse] = (submitted, released, pmid, title)
+    cur = metadb.execute("select gse, status, pubmed_id, title from gse" + series_filter)
+    for (gse, status, pmid, title) in tqdm.tqdm(cur):
+        if gse in released:
+            gse_released = released[gse]
+        else:
+            # series without samples
+            gse_released = parse_date(status)
+        all_gse.append(gse)
+        all_results[gse] = (submitted.get(gse), gse_released, pmid, title)
+    cur.close()
 
     return all_gse, all_results
 
@@ -102,7 +123,7 @@ def insert_data(dbcon, all_gse, all_results):
         if len(data) == 0:
             added += 1
             cur.execute(
-                "INSERT into mentions (acc, paperid) values (?, ?)", (gse, paperid))
+                "INSERT into mentions (acc, paperid, acc_type) values (?, ?, 'GSE')", (gse, paperid))
     dbcon.commit()
     cur.close()
 
@@ -110,29 +131,185 @@ def insert_data(dbcon, all_gse, all_results):
     print "Not found: ", len(not_found_pmids)
 
 
+def merge_datasets(dbcon, all_gse, all_results, update_existing=False):
+    # expects GEOmetadb to be attached as geo
+    dbcon.execute(
+        "create temp table gse_dates(gse text primary key, released date, submitted date)")
+    dbcon.executemany("insert into temp.gse_dates(gse, released, submitted) values (?, ?, ?)",
+                      ((gse, all_results[gse][1], all_results[gse][0]) for gse in all_gse))
+
+    if update_existing:
+        # the series whose fingerprint changed: title, pubmed id (added once
+        # the paper is out) and the dates of samples that were added or
+        # changed their status
+        cur = dbcon.execute("""update datasets set
+            title = (select g.title from geo.gse g where g.gse = datasets.acc),
+            pmid_ref = (select g.pubmed_id from geo.gse g where g.gse = datasets.acc),
+            first_public_on = (select d.released from temp.gse_dates d where d.gse = datasets.acc),
+            first_submitted_on = (select d.submitted from temp.gse_dates d where d.gse = datasets.acc)
+            where acc in (select gse from temp.gse_dates)""")
+        print "Updated datasets: ", cur.rowcount
+        derived_tables.refresh_first_mention(dbcon, all_gse)
+
+    cur = dbcon.execute("""insert into datasets(acc, title, first_public_on, first_submitted_on, pmid_ref)
+        select g.gse, g.title, d.released, d.submitted, g.pubmed_id
+            from geo.gse g, temp.gse_dates d
+            where d.gse = g.gse and not exists (select 1 from datasets ds where ds.acc = g.gse)""")
+    print "New datasets: ", cur.rowcount
+
+    dbcon.execute("drop table temp.gse_dates")
+
+
+def backfill_mentions(dbcon):
+    # expects GEOmetadb to be attached as geo. Runs over all series, since
+    # new papers can match series that did not change.
+    dbcon.execute("""create temp table new_mentions as
+        select distinct p.paperid, g.gse as acc from geo.gse g, papers p
+            where p.pmid = g.pubmed_id and
+                not exists (select 1 from mentions m where m.acc = g.gse and m.paperid = p.paperid)""")
+    cur = dbcon.execute(
+        "insert into mentions(paperid, acc, acc_type) select paperid, acc, 'GSE' from temp.new_mentions")
+    print "New mentions: ", cur.rowcount
+    derived_tables.refresh_first_mention(
+        dbcon, [acc for (acc,) in dbcon.execute("select distinct acc from temp.new_mentions")])
+    dbcon.execute("drop table temp.new_mentions")
+
+    cur = dbcon.execute("""select count(*) from geo.gse g
+            where g.pubmed_id is not null and
+                not exists (select 1 from papers p where p.pmid = g.pubmed_id)""")
+    print "Not found: ", cur.fetchone()[0]
+
+
+def merge_attached(dbcon, metadb_filename, all_gse, all_results,
+                   update_existing=False):
+    # same result as insert_data, done by a few INSERT ... SELECT statements
+    # against the attached GEOmetadb instead of queries per GSE
+    dbcon.execute("ATTACH DATABASE ? AS geo", (metadb_filename,))
+    if all_gse is not None:
+        merge_datasets(dbcon, all_gse, all_results, update_existing)
+    backfill_mentions(dbcon)
+    dbcon.commit()
+    dbcon.execute("DETACH DATABASE geo")
+
+
+def get_metadb_stamp(metadb):
+    cur = metadb.execute(
+        "select value from metaInfo where name='creation timestamp'")
+    return cur.fetchone()[0]
+
+
+def get_stored_stamp(dbcon):
+    dbcon.executescript(
+        "create table if not exists metadata(name text unique, value text);")
+    data = dbcon.execute(
+        "select value from metadata where name='GEOmetadb timestamp'").fetchall()
+    if len(data) == 0:
+        return None
+    return data[0][0]
+
+
 def update_metadb_stamp(dbcon, metadb):
     dbcon.executescript(
         "create table if not exists metadata(name text unique, value text);")
-    cur = metadb.execute(
-        "select value from metaInfo where name='creation timestamp'")
-    metaTimestamp = cur.fetchone()[0]
+    metaTimestamp = get_metadb_stamp(metadb)
 
     dbcon.execute(
         "INSERT or replace into metadata(name, value) values ('GEOmetadb timestamp', ?);", (metaTimestamp, ))
     dbcon.commit()
 
 
+def get_fingerprints(metadb):
+    # anything GEO changes about a series or its samples touches one of these
+    cur = metadb.execute("""select gse.gse, gse.status, gse.last_update_date, gse.pubmed_id, gse.title,
+                                count(gsm.gsm), max(gsm.last_update_date), min(gsm.status), max(gsm.status)
+                            from gse left join gse_gsm on gse_gsm.gse = gse.gse
+                                left join gsm on gsm.gsm = gse_gsm.gsm
+                            group by gse.gse""")
+    result = {}
+    for row in cur:
+        result[row[0]] = hashlib.md5(repr(row[1:])).hexdigest()
+    cur.close()
+    return result
+
+
+def get_changed_gses(dbcon, fingerprints):
+    dbcon.executescript(
+        "create table if not exists geo_fingerprints(gse text primary key, fingerprint text);")
+    stored = dict(dbcon.execute("select gse, fingerprint from geo_fingerprints"))
+    return [gse for (gse, fingerprint) in fingerprints.items()
+            if stored.get(gse) != fingerprint]
+
+
+def store_fingerprints(dbcon, fingerprints, gses):
+    dbcon.executemany("insert or replace into geo_fingerprints(gse, fingerprint) values (?, ?)",
+                      ((gse, fingerprints[gse]) for gse in gses))
+    dbcon.commit()
+
+
 def main():
-    metadb = sqlite3.connect("metadata/GEOmetadb.sqlite")
-    dbcon = sqlite3.connect("data/odw.sqlite")
+    parser = argparse.ArgumentParser(
+        description='Add GEOmetadb series to the datawatch database')
+
+    parser.add_argument("--metadb", default="metadata/GEOmetadb.sqlite")
+    parser.add_argument("--row-merge", action="store_true",
+                        help="check and insert every GSE separately instead of "
+                        "merging the attached GEOmetadb with INSERT ... SELECT")
+    parser.add_argument("--delta", action="store_true",
+                        help="only parse the series that changed since the "
+                        "previous --delta run")
+    parser.add_argument("--force", action="store_true",
+                        help="parse the series even if this GEOmetadb snapshot "
+                        "was already processed")
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.row_merge and args.delta:
+        # insert_data only adds the mentions of the series it is given
+        parser.error("--row-merge cannot be combined with --delta")
+    instrument.configure(args)
+
+    metadb = instrument.connect(args.metadb)
+    dbcon = instrument.connect("data/odw.sqlite")
+    derived_tables.setup_derived_tables(dbcon)
+
+    if not args.force and get_stored_stamp(dbcon) == get_metadb_stamp(metadb):
+        print "GEOmetadb snapshot", get_metadb_stamp(metadb), "was already processed"
+        # papers may have been added since, they still need their mentions
+        with instrument.stage("backfill_mentions"):
+            merge_attached(dbcon, args.metadb, None, None)
+        dbcon.close()
+        instrument.finish(args)
+        return
+
+    gses = None
+    if args.delta:
+        print "Comparing series with the previous snapshot..."
+        with instrument.stage("fingerprints") as stage:
+            fingerprints = get_fingerprints(metadb)
+            gses = get_changed_gses(dbcon, fingerprints)
+            stage["items"] = len(fingerprints)
+        print "Changed series: ", len(gses)
 
     print "Parsing metadb..."
-    all_gse, all_results = parse_metadb(metadb)
+    with instrument.stage("parse_metadb") as stage:
+        all_gse, all_results = parse_metadb(metadb, gses)
+        stage["items"] = len(all_gse)
     print "Inserting data..."
-    insert_data(dbcon, all_gse, all_results)
+    with instrument.stage("merge") as stage:
+        if args.row_merge:
+            insert_data(dbcon, all_gse, all_results)
+            derived_tables.rebuild_first_mention(dbcon)
+            dbcon.commit()
+        else:
+            merge_attached(dbcon, args.metadb, all_gse, all_results,
+                           update_existing=args.delta)
+        stage["items"] = len(all_gse)
 
+    if args.delta:
+        store_fingerprints(dbcon, fingerprints, gses)
     update_metadb_stamp(dbcon, metadb)
     dbcon.close()
+    instrument.finish(args)
 
 if __name__ == "__main__":
     main()
@@ -8,8 +8,24 @@ import tqdm
 import re
 import sqlite3
 import unicodedata
-from contextlib import closing
+from contextlib import closing, contextmanager
 import os
+import argparse
+import collections
+import itertools
+import multiprocessing
+import time
+
+import io
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+import accessions
+import derived_tables
+import instrument
 
 import logging
 logging.basicConfig(filename='parse_papers.log', level=logging.DEBUG)
@@ -133,9 +149,7 @@ def get_date(root):
     return None
 
 
-def parse_file(data):
-    root = ET.fromstring(data)
-
+def parse_element(root):
     result = {"date": get_date(root),
               "title": get_title(root),
               "authors": get_authors(root),
@@ -146,31 +160,251 @@ def parse_file(data):
     return result
 
 
-gse_expr = re.compile("GSE[0-9]+")
-srx_expr = re.compile("SRX[0-9]+")
+def is_complete(result):
+    return result["date"] is not None and result["title"] is not None and \
+        (result["pmc"] is not None or result["pmid"] is not None or result["doi"] is not None)
+
+
+def parse_file(data):
+    root = ET.fromstring(data)
+    # the metadata of the article is in <front>, sub-articles (reviews,
+    # author responses) have contributors and ids of their own; the whole
+    # document is only used for the articles where something is missing
+    # there
+    front = root.find("front")
+    if front is not None:
+        result = parse_element(front)
+        if is_complete(result):
+            return result
+    return parse_element(root)
+
+
+def parse_front(data):
+    # parse the article only up to the end of <front>, which holds all of
+    # the metadata we need, and skip building the tree of the body
+    context = lxml_etree.iterparse(io.BytesIO(data), events=("end",),
+                                   tag="front", huge_tree=True)
+    for (event, el) in context:
+        return el
+    return None
+
+
+def single_value(values, what):
+    if len(values) > 1:
+        logging.warning("Warning, more than one %s detected" %
+                        what, extra={"n": len(values)})
+        return None
+    elif len(values) == 1:
+        return values[0]
+    else:
+        return None
+
+
+def lxml_nametotext(el):
+    # lxml also returns the comments and processing instructions as
+    # children, ElementTree drops them
+    return ", ".join(innertext(child) for child in el
+                     if isinstance(child.tag, basestring))
+
+
+def extract_front(front):
+    # resolves the same fields as parse_file in a single walk over <front>
+    meta_ids = {"pmid": [], "pmc": [], "doi": []}
+    other_ids = {"pmid": [], "pmc": [], "doi": []}
+    meta_titles = []
+    other_titles = []
+    journals = []
+    authors = []
+    pub_dates = {}
+    all_pub_dates = []
+
+    for el in front.iter():
+        tag = el.tag
+        if tag == "article-id":
+            kind = el.get("pub-id-type")
+            if kind in meta_ids:
+                if any(True for _ in el.iterancestors("article-meta")):
+                    meta_ids[kind].append(el.text)
+                else:
+                    other_ids[kind].append(el.text)
+        elif tag == "article-title":
+            if el.getparent().tag == "title-group":
+                if any(True for _ in el.iterancestors("article-meta")):
+                    meta_titles.append(innertext(el))
+                else:
+                    other_titles.append(innertext(el))
+        elif tag == "journal-id":
+            if el.get("journal-id-type") == "nlm-ta":
+                journals.append(innertext(el))
+        elif tag == "name":
+            contrib = el.getparent()
+            if (contrib.tag == "contrib" and contrib.get("contrib-type") == "author" and
+                    contrib.getparent().tag == "contrib-group"):
+                authors.append(lxml_nametotext(el))
+        elif tag == "pub-date":
+            all_pub_dates.append(el)
+            for key in [("pub-type", el.get("pub-type")), ("date-type", el.get("date-type"))]:
+                if key not in pub_dates:
+                    pub_dates[key] = el
+
+    result = {"authors": authors}
+    for kind in meta_ids:
+        result[kind] = single_value(meta_ids[kind] or other_ids[kind], kind)
+    result["title"] = single_value(meta_titles or other_titles, "title")
+    result["journal"] = single_value(journals, "NLM")
+
+    result["date"] = None
+    for (key, allow_month_only) in [(("pub-type", "epub"), False),
+                                    (("pub-type", "pmc-release"), False),
+                                    (("date-type", "pub"), False),
+                                    (("pub-type", "ppub"), True)]:
+        result["date"] = parse_date(pub_dates.get(key), allow_month_only)
+        if result["date"] is not None:
+            break
+    return result
+
+
+def parse_file_lxml(data):
+    # anything the fast path cannot handle is left to the full parse
+    try:
+        front = parse_front(data)
+        result = None
+        if front is not None:
+            result = extract_front(front)
+    except Exception as e:
+        logging.warning("lxml extraction failed", exc_info=e)
+        result = None
+    # the full parse also looks outside of <front>, let it handle the
+    # articles where something is missing there
+    if result is None or not is_complete(result):
+        return parse_file(data)
+    return result
+
+
+use_lxml = lxml_etree is not None
+
+
+def set_use_lxml(value):
+    # has to be called before the worker pool is started
+    global use_lxml
+    use_lxml = value and lxml_etree is not None
+
+
+def extract_metadata(data):
+    if use_lxml:
+        return parse_file_lxml(data)
+    return parse_file(data)
+
+
+class AccessionScanner(object):
+    # Most articles mention no accession at all, so the text is first
+    # checked for the bare prefixes, which is much cheaper than running
+    # the regexp, and a single alternation regexp is run over the rest.
+
+    def __init__(self, families):
+        self.prefixes = [accessions.FAMILIES[f].prefix for f in families]
+        self.expr = re.compile(
+            "|".join(accessions.FAMILIES[f].pattern for f in families))
+
+    def findall(self, text):
+        for prefix in self.prefixes:
+            if prefix in text:
+                return self.expr.findall(text)
+        return []
+
+
+accession_scanner = AccessionScanner(accessions.DEFAULT_FAMILIES)
+
+
+def set_accession_families(families):
+    # has to be called before the worker pool is started
+    global accession_scanner
+    accession_scanner = AccessionScanner(families)
 
-all_accessions_regexps = [gse_expr, srx_expr]
 
 def find_accs(text):
-    result = []
-    for r in all_accessions_regexps:
-        result.extend(r.findall(text))
+    return accession_scanner.findall(text)
+
+
+def process_member(data, keep_empty=False):
+    all_accs = find_accs(data)
+    if len(all_accs) == 0 and not keep_empty:
+        return None
+    result = extract_metadata(data)
+    result["gses"] = list(set(all_accs))
     return result
 
-def process_tar_file(fn):
-    tf = tarfile.open(fn, "r")
-    all_results = []
-    for m in tqdm.tqdm(tf):
+
+def process_batch(batch):
+    members = []
+    results = []
+    replaced = []
+    for (member, data, changed) in batch:
+        members.append(member)
+        # a changed member replaces what its previous version added, even
+        # if it no longer mentions any accession
+        result = process_member(data, keep_empty=changed)
+        if result is None:
+            continue
+        if changed:
+            replaced.append(result)
+        else:
+            results.append(result)
+    return members, results, replaced
+
+
+def iter_members(tf):
+    # TarFile remembers every member it has read, forget them as we go so
+    # that memory does not grow with the size of the archive
+    m = tf.next()
+    while m is not None:
+        yield m
+        tf.members = []
+        m = tf.next()
+
+
+def iter_member_batches(tf, batch_size, status=None):
+    batch = []
+    for m in tqdm.tqdm(iter_members(tf)):
         if m.isfile():
-            data = tf.extractfile(m).read()
-            all_accs = find_accs(data)
-            if len(all_accs) == 0:
-                continue
-            result = parse_file(data)
-            result["gses"] = list(set(all_accs))
-            all_results.append(result)
+            member = (m.name, m.size, m.mtime)
+            state = "new"
+            if status is not None:
+                state = status(member)
+                if state == "processed":
+                    continue
+            batch.append((member, tf.extractfile(m).read(), state == "changed"))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+
+def imap_bounded(pool, func, iterable, max_pending):
+    # like pool.imap, but never reads more than max_pending items ahead
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def process_tar_file(fn, pool=None, batch_size=1000, max_pending=2,
+                     status=None):
+    # members are read and decompressed here, the accession scan and
+    # the XML parsing of each batch run in the pool workers
+    tf = tarfile.open(fn, "r")
+    batches = iter_member_batches(tf, batch_size, status)
+    if pool is None:
+        batch_results = itertools.imap(process_batch, batches)
+    else:
+        batch_results = imap_bounded(pool, process_batch, batches, max_pending)
+    for (members, results, replaced) in batch_results:
+        yield members, results, replaced
     tf.close()
-    return all_results
 
 
 def normalize(s):
@@ -180,25 +414,90 @@ def normalize(s):
     return s
 
 
-def setup_db(dbcon):
-    dbcon.executescript("""
--- core tables
-create table authors(authorid integer primary key, name text);
-create table papers(paperid integer primary key, title text, doi text UNIQUE, pmid integer UNIQUE, pmc integer UNIQUE, published_on date, journal_nlm text);
-create table datasets(acc text primary key, title text, first_public_on date, first_submitted_on date, pmid_ref integer);
+@contextmanager
+def timed(phase):
+    with instrument.stage(phase) as stage:
+        yield stage
+    print "%s took %.1f s" % (phase, stage["seconds"])
 
-create table authorof(authorid int not null, paperid int not null);
-create table mentions(paperid int not null, acc text not null);
 
+TABLES_SCRIPT = """
+-- core tables
+create table if not exists authors(authorid integer primary key, name text);
+create table if not exists papers(paperid integer primary key, title text, doi text UNIQUE, pmid integer UNIQUE, pmc integer UNIQUE, published_on date, journal_nlm text);
+create table if not exists datasets(acc text primary key, title text, first_public_on date, first_submitted_on date, pmid_ref integer);
 
-create index authors_name_idx on authors(name);
-create index mentions_paperid_idx on mentions(paperid);
-create index mentions_acc_idx on mentions(acc);
-create index authorof_authorid_idx on authorof(authorid);
-create index authorof_paperid_idx on authorof(paperid);
+create table if not exists authorof(authorid int not null, paperid int not null);
+create table if not exists mentions(paperid int not null, acc text not null, acc_type text);
+
+-- archive members that were already parsed, for incremental runs
+create table if not exists processed_members(member text primary key, archive text, size integer, mtime integer);
 
 PRAGMA synchronous=OFF;
-""")
+"""
+
+INDEX_SCRIPT = """
+create index if not exists authors_name_idx on authors(name);
+create index if not exists mentions_paperid_idx on mentions(paperid);
+create index if not exists mentions_acc_idx on mentions(acc);
+create index if not exists mentions_acc_type_idx on mentions(acc_type, acc);
+create index if not exists authorof_authorid_idx on authorof(authorid);
+create index if not exists authorof_paperid_idx on authorof(paperid);
+"""
+
+DROP_INDEX_SCRIPT = """
+drop index if exists authors_name_idx;
+drop index if exists mentions_paperid_idx;
+drop index if exists mentions_acc_idx;
+drop index if exists mentions_acc_type_idx;
+drop index if exists authorof_authorid_idx;
+drop index if exists authorof_paperid_idx;
+"""
+
+# no rollback journal and a large page cache, only meant for a build that
+# is started over from scratch if it fails
+BULK_PRAGMAS = """
+PRAGMA journal_mode=OFF;
+PRAGMA cache_size=-1048576;
+PRAGMA mmap_size=2147418112;
+PRAGMA temp_store=MEMORY;
+"""
+
+
+def setup_db(dbcon, with_indexes=True):
+    dbcon.executescript(TABLES_SCRIPT)
+    accessions.ensure_acc_type(dbcon)
+    if with_indexes:
+        dbcon.executescript(INDEX_SCRIPT)
+    derived_tables.setup_derived_tables(dbcon)
+
+
+def has_papers(dbcon):
+    tables = dbcon.execute(
+        "select name from sqlite_master where type='table' and name='papers'").fetchall()
+    return len(tables) > 0 and \
+        dbcon.execute("select count(*) from papers").fetchone()[0] > 0
+
+
+def setup_bulk_db(dbcon):
+    # without a journal a crash can corrupt the database, so a bulk build
+    # only ever writes to a new one
+    if has_papers(dbcon):
+        raise ValueError("A bulk build needs a new database, this one has papers")
+    # secondary indexes are built once by finish_bulk_db after the load
+    setup_db(dbcon, with_indexes=False)
+    dbcon.executescript(DROP_INDEX_SCRIPT)
+    dbcon.executescript(BULK_PRAGMAS)
+
+
+def finish_bulk_db(dbcon):
+    with timed("Building indexes"):
+        dbcon.executescript(INDEX_SCRIPT)
+    with timed("Building first_mention"):
+        derived_tables.rebuild_first_mention(dbcon)
+        dbcon.commit()
+    with timed("Analyze"):
+        dbcon.executescript("ANALYZE;")
 
 
 def get_author_id(dbcon, author):
@@ -241,9 +540,22 @@ def try_find_paper(dbcon, paper):
     return try_find_paper_by_column(dbcon, paper, "doi")
 
 
+def insert_new_mentions(dbcon, paperid, accs):
+    with closing(dbcon.cursor()) as cur:
+        for acc in accs:
+            cur.execute(
+                "select 1 from mentions where paperid=? and acc=?", (paperid, acc))
+            if len(cur.fetchall()) == 0:
+                cur.execute("insert into mentions(paperid, acc, acc_type) values (?, ?, ?)",
+                            (paperid, acc, accessions.acc_type(acc)))
+
+
 def try_insert_paper(dbcon, paper):
     paperid = try_find_paper(dbcon, paper)
     if paperid is not None:
+        # the article may have been seen before in another archive or in
+        # an older version, keep whatever new accessions it mentions
+        insert_new_mentions(dbcon, paperid, paper["gses"])
         return paperid
 
     # need to insert
@@ -259,33 +571,411 @@ def try_insert_paper(dbcon, paper):
                 "insert into authorof(authorid, paperid) values (?, ?)", (aid, paperid))
 
         for gse in paper["gses"]:
-            cur.execute(
-                "insert into mentions(paperid, acc) values (?, ?)", (paperid, gse))
+            cur.execute("insert into mentions(paperid, acc, acc_type) values (?, ?, ?)",
+                        (paperid, gse, accessions.acc_type(gse)))
     # dbcon.commit()
     return paperid
 
 
-def process_tar_to_db(dbcon, fn):
+def paper_key(column, value):
+    # mirror the integer affinity of the pmc/pmid columns, so that keys
+    # read back from the database match the strings found in the XML
+    if column != "doi":
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return value
+
+
+class PaperLoader(object):
+    # Bulk counterpart of try_insert_paper: authors and papers are looked
+    # up in dictionaries seeded once from the database, new rows are
+    # queued and written with executemany by flush().
+
+    def __init__(self, dbcon, refresh_derived=True):
+        self.dbcon = dbcon
+        # keep first_mention current on every flush, a bulk build rebuilds
+        # it once at the end instead
+        self.refresh_derived = refresh_derived
+        self.author_ids = {}
+        self.paper_ids = {"pmc": {}, "pmid": {}, "doi": {}}
+
+        for (authorid, name) in dbcon.execute("select authorid, name from authors"):
+            self.author_ids[name] = authorid
+
+        for row in dbcon.execute("select paperid, pmc, pmid, doi from papers"):
+            for (column, value) in zip(["pmc", "pmid", "doi"], row[1:]):
+                if value is not None:
+                    self.paper_ids[column][value] = row[0]
+
+        self.mentions = set(dbcon.execute("select paperid, acc from mentions"))
+
+        self.next_authorid = self._next_id("select max(authorid) from authors")
+        self.next_paperid = self._next_id("select max(paperid) from papers")
+
+        self.new_authors = []
+        self.new_papers = []
+        self.new_authorof = []
+        self.new_mentions = []
+        # accessions that lost a mention to replace(), their first_mention
+        # rows are refreshed by the next flush
+        self.removed_accs = set()
+
+    def _next_id(self, query):
+        last = self.dbcon.execute(query).fetchone()[0]
+        if last is None:
+            return 1
+        return last + 1
+
+    def get_author_id(self, author):
+        author = normalize(author)
+        authorid = self.author_ids.get(author)
+        if authorid is None:
+            authorid = self.next_authorid
+            self.next_authorid += 1
+            self.author_ids[author] = authorid
+            self.new_authors.append((authorid, author))
+        return authorid
+
+    def find_paper(self, paper):
+        for column in ["pmc", "pmid", "doi"]:
+            if paper[column] is not None:
+                paperid = self.paper_ids[column].get(
+                    paper_key(column, paper[column]))
+                if paperid is not None:
+                    return paperid
+        return None
+
+    def add_mentions(self, paperid, accs):
+        for acc in accs:
+            if (paperid, acc) not in self.mentions:
+                self.mentions.add((paperid, acc))
+                self.new_mentions.append((paperid, acc))
+
+    def add(self, paper):
+        paperid = self.find_paper(paper)
+        if paperid is not None:
+            self.add_mentions(paperid, paper["gses"])
+            return paperid
+
+        authorids = map(self.get_author_id, paper["authors"])
+
+        paperid = self.next_paperid
+        self.next_paperid += 1
+        for column in ["pmc", "pmid", "doi"]:
+            if paper[column] is not None:
+                self.paper_ids[column][paper_key(column, paper[column])] = paperid
+        self.new_papers.append((paperid, paper["title"], paper["doi"], paper["pmid"],
+                                paper["pmc"], paper["date"], paper["journal"]))
+
+        for aid in authorids:
+            self.new_authorof.append((aid, paperid))
+        self.add_mentions(paperid, paper["gses"])
+        return paperid
+
+    def replace(self, paper):
+        # a changed version of an article that was loaded before, its
+        # fields, authors and mentions replace the old ones
+        paperid = self.find_paper(paper)
+        if paperid is None:
+            if len(paper["gses"]) == 0:
+                return None
+            return self.add(paper)
+
+        # the queued rows may belong to the same paper
+        self.flush()
+        old_accs = [acc for (acc,) in self.dbcon.execute(
+            "select acc from mentions where paperid=?", (paperid,))]
+        self.dbcon.execute("update papers set title=?, doi=?, pmid=?, published_on=?, journal_nlm=? where paperid=?",
+                           (paper["title"], paper["doi"], paper["pmid"], paper["date"],
+                            paper["journal"], paperid))
+        for column in ["pmc", "pmid", "doi"]:
+            if paper[column] is not None:
+                self.paper_ids[column][paper_key(column, paper[column])] = paperid
+        self.dbcon.execute("delete from authorof where paperid=?", (paperid,))
+        self.dbcon.execute("delete from mentions where paperid=?", (paperid,))
+        self.mentions.difference_update((paperid, acc) for acc in old_accs)
+        self.removed_accs.update(old_accs)
+
+        for aid in map(self.get_author_id, paper["authors"]):
+            self.new_authorof.append((aid, paperid))
+        self.add_mentions(paperid, paper["gses"])
+        return paperid
+
+    def pending(self):
+        return len(self.new_papers) + len(self.new_mentions)
+
+    def flush(self):
+        with closing(self.dbcon.cursor()) as cur:
+            cur.executemany("insert into authors(authorid, name) values (?, ?)",
+                            self.new_authors)
+            cur.executemany("insert into papers(paperid, title, doi, pmid, pmc, published_on, journal_nlm) values (?, ?, ?, ?, ?, ?, ?)",
+                            self.new_papers)
+            cur.executemany("insert into authorof(authorid, paperid) values (?, ?)",
+                            self.new_authorof)
+            cur.executemany("insert into mentions(paperid, acc, acc_type) values (?, ?, ?)",
+                            ((paperid, acc, accessions.acc_type(acc))
+                             for (paperid, acc) in self.new_mentions))
+        accs = set(acc for (paperid, acc) in self.new_mentions) | self.removed_accs
+        if self.refresh_derived and len(accs) > 0:
+            derived_tables.refresh_first_mention(self.dbcon, accs)
+        self.removed_accs = set()
+        self.new_authors = []
+        self.new_papers = []
+        self.new_authorof = []
+        self.new_mentions = []
+
+
+def member_status(dbcon, member):
+    # "new", "processed" or "changed" (processed with another size or mtime)
+    (name, size, mtime) = member
+    cur = dbcon.execute(
+        "select size, mtime from processed_members where member=?", (name,))
+    data = cur.fetchall()
+    if len(data) == 0:
+        return "new"
+    if data[0] == (size, mtime):
+        return "processed"
+    return "changed"
+
+
+def record_processed_members(dbcon, archive, members):
+    dbcon.executemany("insert or replace into processed_members(member, archive, size, mtime) values (?, ?, ?, ?)",
+                      [(name, archive, size, mtime) for (name, size, mtime) in members])
+
+
+def process_tar_to_db(dbcon, fn, pool=None, batch_size=1000, max_pending=2,
+                      incremental=False, loader=None, flush_size=10000):
     print "Processing", fn
-    all_results = process_tar_file(fn)
-    print "Trying to add", len(all_results), "papers to the database"
-    for res in tqdm.tqdm(all_results):
-        try_insert_paper(dbcon, res)
+    if loader is None:
+        loader = PaperLoader(dbcon)
+    status = None
+    if incremental:
+        status = lambda member: member_status(dbcon, member)
+    archive = os.path.basename(fn)
+    added = 0
+    parsed = 0
+    for (members, results, replaced) in process_tar_file(fn, pool, batch_size,
+                                                         max_pending, status):
+        for res in results:
+            loader.add(res)
+        for res in replaced:
+            loader.replace(res)
+        # the manifest rows share the transaction of the papers they
+        # produced, which is only committed once the loader is flushed
+        record_processed_members(dbcon, archive, members)
+        if loader.pending() >= flush_size:
+            loader.flush()
+            dbcon.commit()
+        added += len(results) + len(replaced)
+        parsed += len(members)
+    loader.flush()
+    dbcon.commit()
+    instrument.count("parse_papers.members", parsed)
+    instrument.count("parse_papers.papers", added)
+    print "Processed", added, "papers mentioning accessions"
+    return parsed
+
+
+def list_archives(basedir):
+    # sorted so that dated incremental packages are applied in order
+    return sorted(os.path.join(basedir, fn) for fn in os.listdir(basedir)
+                  if fn.endswith("tar.gz"))
+
+
+# Shards: every archive is parsed into its own database by a separate
+# process, and the shards are merged into the main database in the order of
+# the archives. A shard is kept and reused as long as its archive has the
+# same size and mtime. The merge only adds papers and mentions, so shards
+# are always merged into a new database.
+SHARD_INFO_SCRIPT = """
+create table if not exists shard_info(archive text, size integer, mtime integer);
+"""
+
+
+def shard_filename(shard_dir, fn):
+    return os.path.join(shard_dir, os.path.basename(fn) + ".sqlite")
+
+
+def archive_stamp(fn):
+    st = os.stat(fn)
+    return (st.st_size, int(st.st_mtime))
+
+
+def is_shard_current(shard_fn, fn):
+    if not os.path.exists(shard_fn):
+        return False
+    shard = sqlite3.connect(shard_fn)
+    try:
+        shard.executescript(SHARD_INFO_SCRIPT)
+        data = shard.execute("select size, mtime from shard_info").fetchall()
+    finally:
+        shard.close()
+    return len(data) > 0 and data[0] == archive_stamp(fn)
+
+
+def build_shard(params):
+    # runs in a worker process, shard_info is written last so that an
+    # interrupted shard is built again
+    (fn, shard_fn, batch_size, flush_size) = params
+    if is_shard_current(shard_fn, fn):
+        print "Reusing", shard_fn
+        return shard_fn
+    if os.path.exists(shard_fn):
+        os.remove(shard_fn)
+    shard = sqlite3.connect(shard_fn)
+    setup_bulk_db(shard)
+    loader = PaperLoader(shard, refresh_derived=False)
+    process_tar_to_db(shard, fn, None, batch_size, loader=loader,
+                      flush_size=flush_size)
+    shard.executescript(SHARD_INFO_SCRIPT)
+    (size, mtime) = archive_stamp(fn)
+    shard.execute("insert into shard_info(archive, size, mtime) values (?, ?, ?)",
+                  (os.path.basename(fn), size, mtime))
+    shard.commit()
+    shard.close()
+    return shard_fn
+
+
+def iter_shard_papers(shard):
+    # the papers of a shard in insertion order, as extract_metadata returns them
+    authors = collections.defaultdict(list)
+    for (paperid, name) in shard.execute("""select authorof.paperid, authors.name from authorof, authors
+                    where authors.authorid = authorof.authorid order by authorof.rowid"""):
+        authors[paperid].append(name)
+    mentions = collections.defaultdict(list)
+    for (paperid, acc) in shard.execute("select paperid, acc from mentions order by rowid"):
+        mentions[paperid].append(acc)
+    for (paperid, title, doi, pmid, pmc, date, journal) in shard.execute(
+            "select paperid, title, doi, pmid, pmc, published_on, journal_nlm from papers order by paperid"):
+        yield {"title": title, "doi": doi, "pmid": pmid, "pmc": pmc, "date": date,
+               "journal": journal, "authors": authors[paperid],
+               "gses": mentions[paperid]}
+
+
+def merge_shard(dbcon, loader, shard_fn, flush_size=10000):
+    # papers are matched by pmc, pmid and then doi and authors by their
+    # normalized name, like for the papers of the archives
+    shard = sqlite3.connect(shard_fn)
+    added = 0
+    for paper in iter_shard_papers(shard):
+        loader.add(paper)
+        added += 1
+        if loader.pending() >= flush_size:
+            loader.flush()
+            dbcon.commit()
+    loader.flush()
+    dbcon.executemany("insert or replace into processed_members(member, archive, size, mtime) values (?, ?, ?, ?)",
+                      shard.execute("select member, archive, size, mtime from processed_members"))
     dbcon.commit()
+    shard.close()
+    return added
+
+
+def process_tars_sharded(dbcon, archives, shard_dir, pool=None, batch_size=1000,
+                         loader=None, flush_size=10000):
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    if loader is None:
+        loader = PaperLoader(dbcon)
+    params = [(fn, shard_filename(shard_dir, fn), batch_size, flush_size)
+              for fn in archives]
+    if pool is None:
+        shards = itertools.imap(build_shard, params)
+    else:
+        shards = pool.imap(build_shard, params)
+    # imap returns the shards in the order of the archives, the first ones
+    # are merged while the next ones are still being built
+    for shard_fn in shards:
+        with timed("Merging " + shard_fn) as stage:
+            stage["items"] = merge_shard(dbcon, loader, shard_fn, flush_size)
 
 
 def main():
-    dbcon = sqlite3.connect("data/odw.sqlite")
-    setup_db(dbcon)
+    parser = argparse.ArgumentParser(
+        description='Extract GEO/SRA mentions from PMC archives')
+
+    parser.add_argument("archives", nargs="*",
+                        help="archives to process, all of rawdata/ by default")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes parsing articles")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="archive members parsed and inserted at once")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip archive members that are already processed "
+                        "and did not change (e.g. for PMC daily packages); "
+                        "changed members replace their paper's fields, authors "
+                        "and mentions")
+    parser.add_argument("--flush-size", type=int, default=10000,
+                        help="queued rows written to the database per transaction")
+    parser.add_argument("--accessions", default=",".join(accessions.DEFAULT_FAMILIES),
+                        help="comma separated accession families to extract, "
+                        "out of " + ", ".join(sorted(accessions.FAMILIES)))
+    parser.add_argument("--no-lxml", action="store_true",
+                        help="always build the full ElementTree of an article "
+                        "instead of parsing its <front> with lxml")
+    parser.add_argument("--bulk-build", action="store_true",
+                        help="load into a new database without journal and "
+                        "secondary indexes, build the indexes at the end "
+                        "(restart on failure)")
+    parser.add_argument("--shards", default="",
+                        help="parse every archive into its own database in this "
+                        "directory in parallel (--jobs), then merge them into a "
+                        "new database; the shards of unchanged archives are reused")
+    instrument.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.shards != "" and args.incremental:
+        parser.error("--incremental cannot be combined with --shards")
+    instrument.configure(args)
+
+    archives = args.archives
+    if len(archives) == 0:
+        archives = list_archives("rawdata/")
+
+    set_accession_families(args.accessions.split(","))
+    set_use_lxml(not args.no_lxml)
+
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+
+    dbcon = instrument.connect("data/odw.sqlite")
+    if args.shards != "" and has_papers(dbcon):
+        # changed articles would keep what their old version added
+        parser.error("--shards needs a new database, this one has papers "
+                     "(move data/odw.sqlite away first)")
+    with timed("Setup"):
+        if args.bulk_build:
+            try:
+                setup_bulk_db(dbcon)
+            except ValueError as e:
+                parser.error(str(e) + " (move data/odw.sqlite away first)")
+        else:
+            setup_db(dbcon)
+        loader = PaperLoader(dbcon, refresh_derived=not args.bulk_build)
+
+    if args.shards != "":
+        process_tars_sharded(dbcon, archives, args.shards, pool, args.batch_size,
+                             loader, args.flush_size)
+    else:
+        for fn in archives:
+            with timed("Loading " + fn) as stage:
+                stage["items"] = process_tar_to_db(dbcon, fn, pool, args.batch_size,
+                                                   2 * args.jobs, args.incremental,
+                                                   loader, args.flush_size)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    basedir = "rawdata/"
-    files = os.listdir(basedir)
-    for fn in files:
-        if fn.endswith("tar.gz"):
-            process_tar_to_db(dbcon, basedir + fn)
+    if args.bulk_build:
+        finish_bulk_db(dbcon)
 
     dbcon.close()
     print "Done"
+    instrument.finish(args)
 
 if __name__ == "__main__":
     main()
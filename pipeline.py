@@ -0,0 +1,256 @@
+# Runs the refresh (download, parse_papers, parse_geometadb, build_page and
+# build_sra) as a graph of stages. A stage is skipped when its inputs, its
+# script and the stages it depends on did not change since its last
+# successful run, which is recorded in data/pipeline_state.json. Stages
+# whose dependencies are done run concurrently, e.g. the GEO and SRA pages.
+#
+# A failed stage is started again on the next run and picks up where it
+# stopped: parse_papers skips the archive members it already committed
+# (--incremental) and the page builds find the NCBI statuses they already
+# checked in their caches.
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import datetime
+import argparse
+import subprocess
+import threading
+import Queue
+
+
+# files up to this size are fingerprinted by their content, larger ones
+# (archives, GEOmetadb, SRAmetadb) by their size and modification time
+HASH_SIZE_LIMIT = 16 * 1024 * 1024
+
+
+class Stage(object):
+    def __init__(self, name, command, inputs, deps=(), daily=False, cwd="."):
+        self.name = name
+        self.command = command
+        # glob patterns of the files the stage reads
+        self.inputs = inputs
+        self.deps = list(deps)
+        # stages that also depend on the day, e.g. because of the NCBI
+        # statuses they check, run at least once a day
+        self.daily = daily
+        self.cwd = cwd
+
+
+STAGES = [
+    Stage("download", ["sh", "download.sh"], ["rawdata/download.sh", "rawdata/urls.txt"],
+          cwd="rawdata"),
+    Stage("parse_papers", [sys.executable, "parse_papers.py", "--incremental"],
+          ["parse_papers.py", "accessions.py", "derived_tables.py", "rawdata/*.tar.gz"],
+          deps=["download"]),
+    Stage("parse_geometadb", [sys.executable, "parse_geometadb.py"],
+          ["parse_geometadb.py", "derived_tables.py", "metadata/GEOmetadb.sqlite"],
+          deps=["parse_papers"]),
+    Stage("build_page", [sys.executable, "build_page.py"],
+          ["build_page.py", "GEOCacher.py", "output_template.html", "whitelist.txt"],
+          deps=["parse_geometadb"], daily=True),
+    # only needs the mentions of parse_papers, but waits for parse_geometadb
+    # so that it does not read the database while that one writes to it;
+    # build_page, which runs next to it, only reads the database
+    Stage("build_sra", [sys.executable, "build_sra.py"],
+          ["build_sra.py", "SRACacher.py", "sra_template.html", "metadata/SRAmetadb.sqlite"],
+          deps=["parse_geometadb"], daily=True),
+]
+
+
+def file_fingerprint(fn):
+    st = os.stat(fn)
+    if st.st_size > HASH_SIZE_LIMIT:
+        return "size:%d mtime:%d" % (st.st_size, int(st.st_mtime))
+    h = hashlib.sha1()
+    with open(fn, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), ""):
+            h.update(block)
+    return "sha1:" + h.hexdigest()
+
+
+def stage_key(stage, dep_keys):
+    h = hashlib.sha1()
+    h.update(json.dumps(stage.command))
+    for pattern in stage.inputs:
+        for fn in sorted(glob.glob(pattern)):
+            h.update(fn + "\0" + file_fingerprint(fn) + "\0")
+    for dep in stage.deps:
+        h.update(dep + "\0" + str(dep_keys.get(dep)) + "\0")
+    if stage.daily:
+        h.update(str(datetime.date.today()))
+    return h.hexdigest()
+
+
+def load_state(fn):
+    if not os.path.exists(fn):
+        return {}
+    with open(fn) as f:
+        return json.load(f)
+
+
+def save_state(fn, state):
+    # written to a temporary file first, so that a crash cannot leave a
+    # truncated state behind
+    with open(fn + ".tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(fn + ".tmp", fn)
+
+
+print_lock = threading.Lock()
+
+
+def log(message):
+    # stages report from their own threads
+    with print_lock:
+        print message
+        sys.stdout.flush()
+
+
+def run_command(stage, report_dir):
+    command = list(stage.command)
+    if report_dir != "" and stage.command[0] == sys.executable:
+        command += ["--report", os.path.join(os.path.abspath(report_dir),
+                                             stage.name + ".json")]
+    log("[%s] started: %s" % (stage.name, " ".join(command)))
+    start = time.time()
+    code = subprocess.call(command, cwd=stage.cwd)
+    return (code, time.time() - start)
+
+
+class Pipeline(object):
+    def __init__(self, stages, state_fn, jobs=2, report_dir="", force=(),
+                 dry_run=False):
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.order = [stage.name for stage in stages]
+        self.state_fn = state_fn
+        self.state = load_state(state_fn)
+        self.jobs = jobs
+        self.report_dir = report_dir
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.lock = threading.Lock()
+
+    def run(self, selected):
+        # keys of the finished stages, the key of a skipped dependency is
+        # the one of its last successful run
+        keys = {}
+        for name in self.order:
+            if name not in selected and name in self.state:
+                keys[name] = self.state[name]["key"]
+
+        pending = [name for name in self.order if name in selected]
+        running = set()
+        ran = set()
+        failed = set()
+        done = Queue.Queue()
+
+        while len(pending) > 0 or len(running) > 0:
+            for name in list(pending):
+                deps = self.stages[name].deps
+                if any(dep in failed for dep in deps):
+                    log("[%s] not run, a dependency failed" % name)
+                    pending.remove(name)
+                    failed.add(name)
+                    continue
+                if any(dep in pending or dep in running for dep in deps):
+                    continue
+                if len(running) >= self.jobs:
+                    break
+                pending.remove(name)
+                key = stage_key(self.stages[name], keys)
+                # a stage that depends on one that ran has to run as well,
+                # even if the key did not change (e.g. with --force)
+                if self._is_current(name, key) and not any(dep in ran for dep in deps):
+                    log("[%s] inputs unchanged, skipped" % name)
+                    keys[name] = key
+                    continue
+                ran.add(name)
+                if self.dry_run:
+                    log("[%s] would run" % name)
+                    keys[name] = key
+                    continue
+                running.add(name)
+                thread = threading.Thread(target=self._run_stage,
+                                          args=(name, key, done))
+                thread.daemon = True
+                thread.start()
+
+            if len(running) == 0:
+                continue
+            (name, key, ok) = done.get()
+            running.remove(name)
+            if ok:
+                keys[name] = key
+            else:
+                failed.add(name)
+
+        return len(failed) == 0
+
+    def _is_current(self, name, key):
+        if name in self.force:
+            return False
+        return name in self.state and self.state[name]["key"] == key
+
+    def _run_stage(self, name, key, done):
+        ok = False
+        try:
+            (code, seconds) = run_command(self.stages[name], self.report_dir)
+            ok = code == 0
+            if ok:
+                log("[%s] finished in %.1f s" % (name, seconds))
+                with self.lock:
+                    self.state[name] = {"key": key, "seconds": round(seconds, 1),
+                                        "finished": str(datetime.datetime.now())}
+                    save_state(self.state_fn, self.state)
+            else:
+                log("[%s] failed with exit code %d" % (name, code))
+        finally:
+            done.put((name, key, ok))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the datawatch refresh')
+
+    parser.add_argument("stages", nargs="*",
+                        help="stages to run, all but download by default, "
+                        "out of " + ", ".join(stage.name for stage in STAGES))
+    parser.add_argument("--download", action="store_true",
+                        help="also download the PMC archives")
+    parser.add_argument("--force", default="",
+                        help="comma separated stages to run even if unchanged")
+    parser.add_argument("--jobs", type=int, default=2,
+                        help="number of stages run at the same time")
+    parser.add_argument("--state", default="data/pipeline_state.json")
+    parser.add_argument("--reports", default="",
+                        help="directory for the run reports of the stages")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only print the stages that would run")
+
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    names = [stage.name for stage in STAGES]
+    selected = args.stages
+    if len(selected) == 0:
+        selected = [name for name in names if name != "download"]
+    if args.download and "download" not in selected:
+        selected.append("download")
+    for name in selected:
+        if name not in names:
+            parser.error("unknown stage " + name)
+    if args.reports != "" and not os.path.exists(args.reports):
+        os.makedirs(args.reports)
+
+    pipeline = Pipeline(STAGES, args.state, args.jobs, args.reports,
+                        [x for x in args.force.split(",") if x != ""],
+                        args.dry_run)
+    if not pipeline.run(set(selected)):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
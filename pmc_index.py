@@ -0,0 +1,292 @@
+# Random access to the articles of the PMC archives. An archive is converted
+# once into a tar.gz made of independent gzip members ("chunks") of about
+# chunk_size bytes of tar data each, and every article gets a row in an
+# index database with its chunk and its offset in the chunk. Reading an
+# article then decompresses a single chunk instead of the archive up to
+# it. The converted archive is still a valid tar.gz, parse_papers reads it
+# like the original.
+#
+# zran-style seek points in the original archives would avoid the
+# conversion, but restarting inflate in the middle of a deflate stream
+# needs inflatePrime/inflateSetDictionary, which Python 2's zlib does not
+# expose.
+
+import os
+import re
+import zlib
+import tarfile
+import sqlite3
+import argparse
+
+import accessions
+import parse_papers
+
+
+INDEX_SCRIPT = """
+create table if not exists archives(archiveid integer primary key, source text unique, filename text, size integer, mtime integer);
+create table if not exists chunks(archiveid int not null, chunkid int not null, offset integer, length integer, primary key(archiveid, chunkid));
+create table if not exists articles(member text, pmc integer, archiveid int not null, chunkid int not null, offset integer, size integer);
+create index if not exists articles_pmc_idx on articles(pmc);
+create index if not exists articles_member_idx on articles(member);
+"""
+
+PMC_EXPR = re.compile(r'<article-id pub-id-type="pmc">\s*(?:PMC)?([0-9]+)\s*</article-id>')
+PMC_NAME_EXPR = re.compile(r"PMC([0-9]+)")
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+def get_pmc(name, data):
+    # the id in the article itself, the file name only if it has none
+    m = PMC_EXPR.search(data)
+    if m is None:
+        m = PMC_NAME_EXPR.search(name)
+    if m is None:
+        return None
+    return int(m.group(1))
+
+
+def gzip_chunk(data):
+    # a complete gzip member, so that the chunks can be concatenated
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def tar_entry(info, data):
+    info.size = len(data)
+    padding = (BLOCK_SIZE - len(data) % BLOCK_SIZE) % BLOCK_SIZE
+    return info.tobuf(tarfile.GNU_FORMAT), data + "\0" * padding
+
+
+class ChunkWriter(object):
+    def __init__(self, out, index, archiveid, chunk_size):
+        self.out = out
+        self.index = index
+        self.archiveid = archiveid
+        self.chunk_size = chunk_size
+        self.chunkid = 0
+        self.parts = []
+        self.length = 0
+        self.articles = []
+
+    def add(self, info, data):
+        (header, body) = tar_entry(info, data)
+        pmc = get_pmc(info.name, data)
+        self.articles.append((info.name, pmc, self.archiveid, self.chunkid,
+                              self.length + len(header), len(data)))
+        self.parts.append(header)
+        self.parts.append(body)
+        self.length += len(header) + len(body)
+        if self.length >= self.chunk_size:
+            self.flush()
+
+    def flush(self, tail=""):
+        if self.length == 0 and tail == "":
+            return
+        offset = self.out.tell()
+        self.out.write(gzip_chunk("".join(self.parts) + tail))
+        self.index.execute("insert into chunks(archiveid, chunkid, offset, length) values (?, ?, ?, ?)",
+                           (self.archiveid, self.chunkid, offset, self.out.tell() - offset))
+        self.index.executemany("insert into articles(member, pmc, archiveid, chunkid, offset, size) values (?, ?, ?, ?, ?, ?)",
+                               self.articles)
+        self.chunkid += 1
+        self.parts = []
+        self.length = 0
+        self.articles = []
+
+    def close(self):
+        # the end of archive marker goes into the last chunk
+        self.flush("\0" * (2 * BLOCK_SIZE))
+
+
+def open_index(index_fn):
+    index = sqlite3.connect(index_fn)
+    index.executescript(INDEX_SCRIPT)
+    return index
+
+
+def convert_archive(src_fn, out_dir, index, chunk_size=1 << 20):
+    # returns the name of the converted archive
+    source = os.path.abspath(src_fn)
+    out_fn = os.path.join(out_dir, os.path.basename(src_fn))
+    if os.path.abspath(out_fn) == source:
+        raise ValueError("The converted archive would replace " + src_fn)
+    old = index.execute("select archiveid from archives where source=?", (source,)).fetchall()
+    for (archiveid,) in old:
+        index.execute("delete from chunks where archiveid=?", (archiveid,))
+        index.execute("delete from articles where archiveid=?", (archiveid,))
+        index.execute("delete from archives where archiveid=?", (archiveid,))
+
+    st = os.stat(src_fn)
+    cur = index.execute("insert into archives(source, filename, size, mtime) values (?, ?, ?, ?)",
+                        (source, os.path.abspath(out_fn), st.st_size, int(st.st_mtime)))
+    writer = ChunkWriter(open(out_fn, "wb"), index, cur.lastrowid, chunk_size)
+    tf = tarfile.open(src_fn, "r")
+    for member in tf:
+        # only regular files are kept, directories do not matter here
+        if member.isfile():
+            writer.add(member, tf.extractfile(member).read())
+        tf.members = []
+    tf.close()
+    writer.close()
+    writer.out.close()
+    index.commit()
+    return out_fn
+
+
+def is_converted(index, src_fn):
+    st = os.stat(src_fn)
+    data = index.execute("select size, mtime from archives where source=?",
+                         (os.path.abspath(src_fn),)).fetchall()
+    return len(data) > 0 and data[0] == (st.st_size, int(st.st_mtime))
+
+
+class PMCIndex(object):
+    def __init__(self, index_fn):
+        self.index = open_index(index_fn)
+        self.files = {}
+        # the last decompressed chunk, articles are often read in runs
+        self.chunk_key = None
+        self.chunk = None
+
+    def _read_chunk(self, archiveid, chunkid):
+        if self.chunk_key == (archiveid, chunkid):
+            return self.chunk
+        if archiveid not in self.files:
+            (filename,) = self.index.execute("select filename from archives where archiveid=?",
+                                             (archiveid,)).fetchone()
+            self.files[archiveid] = open(filename, "rb")
+        (offset, length) = self.index.execute("select offset, length from chunks where archiveid=? and chunkid=?",
+                                              (archiveid, chunkid)).fetchone()
+        f = self.files[archiveid]
+        f.seek(offset)
+        self.chunk = zlib.decompress(f.read(length), 16 + zlib.MAX_WBITS)
+        self.chunk_key = (archiveid, chunkid)
+        return self.chunk
+
+    def _read(self, row):
+        (archiveid, chunkid, offset, size) = row
+        return self._read_chunk(archiveid, chunkid)[offset:offset + size]
+
+    def _lookup(self, column, value):
+        # an article in several archives is read from the last one in the
+        # order of list_archives, i.e. its newest version for dated packages
+        return self.index.execute("""select a.archiveid, a.chunkid, a.offset, a.size
+                    from articles a, archives r where a.archiveid = r.archiveid and a.""" +
+                                  column + "=? order by r.source desc limit 1",
+                                  (value,)).fetchone()
+
+    def get_article(self, pmc):
+        row = self._lookup("pmc", int(str(pmc).replace("PMC", "")))
+        if row is None:
+            return None
+        return self._read(row)
+
+    def get_member(self, name):
+        row = self._lookup("member", name)
+        if row is None:
+            return None
+        return self._read(row)
+
+    def iter_articles(self, pmcs):
+        # yields (pmc, data) grouped by chunk, so that every chunk is only
+        # decompressed once
+        rows = []
+        for pmc in pmcs:
+            pmc = int(str(pmc).replace("PMC", ""))
+            row = self._lookup("pmc", pmc)
+            if row is None:
+                print "Not in the index: PMC%d" % pmc
+            else:
+                rows.append((row, pmc))
+        for (row, pmc) in sorted(rows):
+            yield pmc, self._read(row)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.index.close()
+
+
+def reprocess_pmcs(dbcon, index, pmcs):
+    # parses the given articles again and replaces what the database has
+    # about them, like parse_papers --incremental does for changed archive
+    # members; articles that no longer mention an accession lose their
+    # mentions. Returns the number of articles updated.
+    loader = parse_papers.PaperLoader(dbcon)
+    updated = 0
+    for (pmc, data) in index.iter_articles(pmcs):
+        paper = parse_papers.process_member(data, keep_empty=True)
+        if loader.replace(paper) is not None:
+            updated += 1
+    loader.flush()
+    dbcon.commit()
+    return updated
+
+
+def read_pmcs(fn):
+    # one id per line, with or without the PMC prefix; anything after the
+    # id is ignored, like in whitelist.txt
+    return [line.split()[0] for line in open(fn) if line.strip() != ""]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Random access to the articles of the PMC archives')
+
+    parser.add_argument("--index", default="indexed/pmc_index.sqlite")
+    subparsers = parser.add_subparsers(dest="command")
+
+    convert = subparsers.add_parser("convert", help="convert archives to chunked "
+                                    "tar.gz files in the directory of the index")
+    convert.add_argument("archives", nargs="*",
+                         help="archives to convert, all of rawdata/ by default")
+    convert.add_argument("--chunk-size", type=int, default=1 << 20,
+                         help="uncompressed bytes per gzip chunk")
+    convert.add_argument("--force", action="store_true",
+                         help="convert archives that did not change as well")
+
+    get = subparsers.add_parser("get", help="print an article")
+    get.add_argument("pmc")
+
+    reprocess = subparsers.add_parser("reprocess", help="parse the given "
+                                      "articles again and update the database")
+    reprocess.add_argument("pmcs", help="file with one PMC id per line")
+    reprocess.add_argument("--db", default="data/odw.sqlite")
+    reprocess.add_argument("--accessions", default=",".join(accessions.DEFAULT_FAMILIES),
+                           help="comma separated accession families to extract, "
+                           "out of " + ", ".join(sorted(accessions.FAMILIES)))
+
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        out_dir = os.path.dirname(os.path.abspath(args.index))
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        index = open_index(args.index)
+        archives = args.archives
+        if len(archives) == 0:
+            archives = parse_papers.list_archives("rawdata/")
+        for fn in archives:
+            if not args.force and is_converted(index, fn):
+                print "Already converted", fn
+                continue
+            with parse_papers.timed("Converting " + fn):
+                convert_archive(fn, out_dir, index, args.chunk_size)
+    elif args.command == "get":
+        index = PMCIndex(args.index)
+        data = index.get_article(args.pmc)
+        if data is None:
+            parser.error("%s is not in the index" % args.pmc)
+        print data
+    elif args.command == "reprocess":
+        parse_papers.set_accession_families(args.accessions.split(","))
+        index = PMCIndex(args.index)
+        dbcon = sqlite3.connect(args.db)
+        parse_papers.setup_db(dbcon)
+        with parse_papers.timed("Reprocessing"):
+            updated = reprocess_pmcs(dbcon, index, read_pmcs(args.pmcs))
+        print "Articles updated:", updated
+
+if __name__ == "__main__":
+    main()